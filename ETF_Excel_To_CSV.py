@@ -1,8 +1,30 @@
+import argparse
+import hashlib
+import json
 import requests
 import os
 import shutil
 import datetime
+import glob
+import time
+import openpyxl
 import pandas as pd
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from threading import Lock
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple
+
+# Size of the buffered writes of a download.
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+# Seconds to wait for the server to connect or send data.
+DOWNLOAD_TIMEOUT = 60
+# Partition columns of the holdings store, outermost first.
+STORE_PARTITIONS = ["Date", "Ticker Symbol"]
+# Columns stored as float64; every other column, identifiers included, is stored as strings.
+STORE_NUMERIC_COLUMNS = ["Weight", "Shares Held"]
+# Columns of codes that are kept as text, so that numeric-looking CUSIPs keep their leading zeros.
+IDENTIFIER_COLUMNS = ["Ticker", "Identifier", "SEDOL"]
 
 ETF_Download_Links = {
     "XBI": {
@@ -56,7 +78,74 @@ ETF_Download_Links = {
 }
 
 
-def download_file(download_url: str, download_directory: str, download_name: str) -> str:
+def create_session(pool_size: int) -> requests.Session:
+    """
+    Creates a requests Session whose connection pool can serve the given number of concurrent downloads.
+
+    Parameters:
+    - pool_size (int): The maximum number of connections kept open per host.
+
+    Returns:
+    - requests.Session: The session to share between the downloads.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def fetch_to_file(download_url: str, file_path: str, session: Optional[requests.Session] = None,
+                  retries: int = 0, backoff: float = 1.0,
+                  headers: Optional[Dict[str, str]] = None) -> Optional[Mapping[str, str]]:
+    """
+    Downloads a URL to a file, retrying failed attempts with exponential backoff.
+
+    Parameters:
+    - download_url (str): The URL from which to download the file.
+    - file_path (str): The path of the file to write; it only appears once the download is complete.
+    - session (requests.Session, optional): The session whose connections to reuse.
+    - retries (int): How many times to retry a failed download.
+    - backoff (float): Seconds to wait before the first retry, doubled before each further one.
+    - headers (Dict[str, str], optional): Extra request headers, such as conditional request headers.
+
+    Returns:
+    - Mapping[str, str]: The response headers, or None if the server answered 304 Not Modified.
+
+    Raises:
+    - requests.RequestException: If the last attempt fails, or a client error makes retrying pointless.
+    """
+    partial_download_path = f"{file_path}.part"
+    http = session or requests
+    for attempt in range(retries + 1):
+        try:
+            # Make a GET request to download the file, streaming the content.
+            with http.get(download_url, stream=True, timeout=DOWNLOAD_TIMEOUT, headers=headers) as response:
+                # Raise an exception for bad responses.
+                response.raise_for_status()
+                if response.status_code == 304:
+                    return None
+                # Write the content to the file in large chunks.
+                with open(partial_download_path, "wb") as file:
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        file.write(chunk)
+            # Only a complete download takes the final name.
+            os.replace(partial_download_path, file_path)
+            return response.headers
+        except requests.RequestException as error:
+            status = error.response.status_code if error.response is not None else None
+            # Client errors other than rate limiting will not go away on a retry.
+            if attempt == retries or (status is not None and 400 <= status < 500 and status != 429):
+                raise
+            time.sleep(backoff * 2 ** attempt)
+        finally:
+            # A failed attempt leaves no partial file behind.
+            if os.path.exists(partial_download_path):
+                os.remove(partial_download_path)
+
+
+def download_file(download_url: str, download_directory: str, download_name: str,
+                  session: Optional[requests.Session] = None, retries: int = 0, backoff: float = 1.0) -> str:
     """
     Downloads a file from a given URL and saves it to a specified directory with a specified file name.
 
@@ -64,20 +153,16 @@ def download_file(download_url: str, download_directory: str, download_name: str
     - download_url (str): The URL from which to download the file.
     - download_directory (str): The directory path where the file will be saved.
     - download_name (str): The name of the file to be saved, including the extension.
+    - session (requests.Session, optional): The session whose connections to reuse.
+    - retries (int): How many times to retry a failed download.
+    - backoff (float): Seconds to wait before the first retry, doubled before each further one.
 
     Returns:
     - str: The full path to the downloaded file if successful, an empty string otherwise.
     """
     # Construct the full path where the file will be saved.
     full_download_path = os.path.join(download_directory, f"{download_name}.xlsx")
-    # Make a GET request to download the file, streaming the content.
-    response = requests.get(download_url, stream=True)
-    # Raise an exception for bad responses.
-    response.raise_for_status()
-    # Write the content to the file in chunks.
-    with open(full_download_path, "wb") as file:
-        for chunk in response.iter_content(chunk_size=128):
-            file.write(chunk)
+    fetch_to_file(download_url, full_download_path, session, retries, backoff)
 
     # Verify the file exists to confirm successful download.
     if os.path.exists(full_download_path):
@@ -86,6 +171,44 @@ def download_file(download_url: str, download_directory: str, download_name: str
         return ""
 
 
+def download_files(download_links: Dict[str, str], download_directory: str, name_suffix: str,
+                   workers: int = 4, retries: int = 3, backoff: float = 1.0,
+                   cache: Optional["DownloadCache"] = None, skip_failed: bool = False) -> Dict[str, str]:
+    """
+    Downloads several files concurrently over one pooled session.
+
+    Parameters:
+    - download_links (Dict[str, str]): The URL to download for each ETF code.
+    - download_directory (str): The directory path where the files will be saved.
+    - name_suffix (str): Appended to the ETF code to name each file.
+    - workers (int): The maximum number of downloads running at once.
+    - retries (int): How many times to retry each failed download.
+    - backoff (float): Seconds to wait before the first retry of a download, doubled before each further one.
+    - cache (DownloadCache, optional): The cache to fetch the files through, instead of download_directory.
+    - skip_failed (bool): Whether to skip a download that still fails after its retries instead of raising.
+
+    Returns:
+    - Dict[str, str]: The downloaded file path for each ETF code, an empty string for skipped downloads.
+
+    Raises:
+    - requests.RequestException: If a download fails after its retries and skip_failed is not set.
+    """
+    def download(code: str) -> str:
+        try:
+            if cache is not None:
+                return cache.fetch(code, download_links[code], session, retries, backoff)
+            return download_file(download_links[code], download_directory, f"{code}_{name_suffix}",
+                                 session, retries, backoff)
+        except requests.RequestException as error:
+            if not skip_failed:
+                raise
+            print(f"Error downloading file for {code}: {error}")
+            return ""
+
+    with create_session(workers) as session, ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(download_links, executor.map(download, download_links)))
+
+
 def get_excel_metadata(file_path: str) -> dict:
     """
     Extracts metadata from an Excel file.
@@ -120,7 +243,7 @@ def generate_dataframe(file_path: str, file_metadata: dict) -> pd.DataFrame:
     - pd.DataFrame: A DataFrame containing the data from the Excel file, enriched with metadata.
     """
     # Read the Excel file into a DataFrame, skipping the first four rows.
-    df = pd.read_excel(file_path, skiprows=4)
+    df = pd.read_excel(file_path, skiprows=4, dtype={column: str for column in IDENTIFIER_COLUMNS})
     # Find the first entirely empty row, indicating the end of the data.
     last_index = df[df.isnull().all(axis=1)].index[0]
     # Trim the DataFrame to only include rows with data.
@@ -132,33 +255,500 @@ def generate_dataframe(file_path: str, file_metadata: dict) -> pd.DataFrame:
     return df
 
 
+def excel_cell_value(value: Any) -> Any:
+    """
+    Converts a cell value the way pd.read_excel does before parsing: empty cells to empty strings,
+    and whole floats to ints.
+
+    Parameters:
+    - value (Any): The cell value read by openpyxl.
+
+    Returns:
+    - Any: The converted value.
+    """
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def convert_excel_column(column: pd.Series) -> pd.Series:
+    """
+    Converts a column of cell values the way pd.read_excel does: empty strings become missing values,
+    and a column whose values are all numbers or numeric strings becomes numeric, except for the
+    identifier columns, which become strings.
+
+    Parameters:
+    - column (pd.Series): The cell values, as converted by excel_cell_value.
+
+    Returns:
+    - pd.Series: The converted column.
+    """
+    column = column.mask(column == "")
+    if column.name in IDENTIFIER_COLUMNS:
+        return column.map(str, na_action="ignore")
+    try:
+        return pd.to_numeric(column)
+    except (ValueError, TypeError):
+        return column.infer_objects()
+
+
+def metadata_from_rows(metadata_rows: List[Tuple]) -> dict:
+    """
+    Extracts the metadata from the first rows of an Excel file, as get_excel_metadata does.
+
+    Parameters:
+    - metadata_rows (List[Tuple]): The values of at least the first three rows.
+
+    Returns:
+    - dict: A dictionary containing metadata about the Excel file, including the ticker symbol and date.
+    """
+    return {
+        'Ticker': metadata_rows[1][1],
+        'Date': pd.to_datetime(metadata_rows[2][1], format='As of %d-%b-%Y').strftime('%Y-%m-%d')
+    }
+
+
+def read_workbook_metadata(file_path: str) -> dict:
+    """
+    Extracts metadata from an Excel file, streaming only its first rows.
+
+    Parameters:
+    - file_path (str): The path to the Excel file.
+
+    Returns:
+    - dict: A dictionary containing metadata about the Excel file, including the ticker symbol and date.
+    """
+    workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        return metadata_from_rows(list(workbook.active.iter_rows(max_row=3, values_only=True)))
+    finally:
+        workbook.close()
+
+
+def parse_workbook(file_path: str) -> pd.DataFrame:
+    """
+    Generates the same DataFrame as get_excel_metadata and generate_dataframe in a single read of the
+    Excel file, streaming its rows and stopping at the first empty row after the holdings.
+
+    Parameters:
+    - file_path (str): The path to the Excel file.
+
+    Returns:
+    - pd.DataFrame: A DataFrame containing the data from the Excel file, enriched with metadata.
+    """
+    workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        # The first three rows hold the metadata, the fifth the column names.
+        metadata_rows = [next(rows) for _ in range(4)]
+        data = [[excel_cell_value(value) for value in next(rows)]]
+        for row in rows:
+            values = [excel_cell_value(value) for value in row]
+            # The first entirely empty row marks the end of the data. It is kept until the columns
+            # are converted so that, as with pd.read_excel, its missing values make them float.
+            data.append(values)
+            if all(value == "" for value in values):
+                break
+    finally:
+        workbook.close()
+    file_metadata = metadata_from_rows(metadata_rows)
+    # Pad the rows to one width and convert the columns as pd.read_excel would, naming the columns
+    # from the header row and the unnamed ones by their position.
+    width = max(len(values) for values in data)
+    data = [values + [""] * (width - len(values)) for values in data]
+    columns = [name if name != "" else f"Unnamed: {i}" for i, name in enumerate(data[0])]
+    df = pd.DataFrame(data[1:], columns=columns, dtype=object).apply(convert_excel_column)
+    if all(value == "" for value in data[-1]):
+        df = df.iloc[:-1]
+    # Insert metadata columns at the beginning of the DataFrame.
+    df.insert(0, "Ticker Symbol", file_metadata['Ticker'])
+    df.insert(0, "Date", file_metadata['Date'])
+    df['Weight'] = df['Weight'] / 100
+    return df
+
+
+def parse_workbooks(file_paths: Dict[str, str], workers: int = 4) -> Dict[str, pd.DataFrame]:
+    """
+    Parses several Excel files in parallel across a process pool.
+
+    Parameters:
+    - file_paths (Dict[str, str]): The Excel file path for each ETF code.
+    - workers (int): The number of worker processes.
+
+    Returns:
+    - Dict[str, pd.DataFrame]: The parsed DataFrame for each ETF code, in the order of file_paths.
+    """
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(file_paths, executor.map(parse_workbook, file_paths.values())))
+
+
+class DownloadCache:
+    """
+    Persistent cache of the downloaded Excel files and the DataFrames parsed from them.
+
+    index.json holds, per ETF, the ETag and Last-Modified of the last download, the SHA-256 and
+    path of its content, its "As of" date and its parsed DataFrame. A file is only re-parsed when
+    the server sends new content with a new "As of" date; the reused DataFrames are in `frames`.
+    """
+
+    def __init__(self, cache_dir: str) -> None:
+        self.cache_dir = cache_dir
+        self.index_path = os.path.join(cache_dir, "index.json")
+        os.makedirs(os.path.join(cache_dir, "files"), exist_ok=True)
+        os.makedirs(os.path.join(cache_dir, "frames"), exist_ok=True)
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as index_file:
+                self.index: Dict[str, dict] = json.load(index_file)
+        else:
+            self.index = {}
+        # New entries of the ETFs still to be parsed, committed by store_frame.
+        self.pending: Dict[str, dict] = {}
+        self.frames: Dict[str, pd.DataFrame] = {}
+        self.stats: Counter = Counter()
+        self.lock = Lock()
+
+    def _commit(self, code: str, entry: dict) -> None:
+        """Makes an entry the ETF's current one, removing the file and frame it supersedes."""
+        with self.lock:
+            previous = self.index.get(code, {})
+            self.index[code] = entry
+        for key in ("file", "frame"):
+            previous_path = previous.get(key)
+            if previous_path and previous_path != entry.get(key) and os.path.exists(previous_path):
+                os.remove(previous_path)
+
+    def _reuse(self, code: str, entry: dict, outcome: str) -> str:
+        """Records a cache hit and loads the ETF's cached DataFrame."""
+        self.frames[code] = pd.read_pickle(entry["frame"])
+        self._commit(code, entry)
+        with self.lock:
+            self.stats[outcome] += 1
+        return entry["file"]
+
+    def fetch(self, code: str, download_url: str, session: Optional[requests.Session] = None,
+              retries: int = 0, backoff: float = 1.0) -> str:
+        """
+        Downloads an ETF's Excel file unless the cached one is still current.
+
+        Parameters:
+        - code (str): The ETF code.
+        - download_url (str): The URL from which to download the file.
+        - session (requests.Session, optional): The session whose connections to reuse.
+        - retries (int): How many times to retry a failed download.
+        - backoff (float): Seconds to wait before the first retry, doubled before each further one.
+
+        Returns:
+        - str: The path to the cached file; its DataFrame is in `frames` unless it has to be parsed.
+        """
+        entry = dict(self.index.get(code, {}))
+        cached = "frame" in entry and os.path.exists(entry["frame"]) and os.path.exists(entry["file"])
+        headers = {}
+        if cached and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if cached and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        download_path = os.path.join(self.cache_dir, "files", f"{code}.download")
+        response_headers = fetch_to_file(download_url, download_path, session, retries, backoff, headers)
+        if response_headers is None:
+            return self._reuse(code, entry, "not modified")
+        entry["etag"] = response_headers.get("ETag")
+        entry["last_modified"] = response_headers.get("Last-Modified")
+        with open(download_path, "rb") as file:
+            file_hash = hashlib.sha256(file.read()).hexdigest()
+        if cached and file_hash == entry["sha256"]:
+            os.remove(download_path)
+            return self._reuse(code, entry, "same content")
+        # Files are stored under their content hash, so a new file never overwrites a cached one.
+        file_path = os.path.join(self.cache_dir, "files", f"{code}_{file_hash[:16]}.xlsx")
+        os.replace(download_path, file_path)
+        entry["sha256"] = file_hash
+        entry["file"] = file_path
+        entry["date"] = read_workbook_metadata(file_path)["Date"]
+        if cached and entry["date"] == self.index[code]["date"]:
+            return self._reuse(code, entry, "same date")
+        with self.lock:
+            self.pending[code] = entry
+            self.stats["parsed"] += 1
+        return file_path
+
+    def store_frame(self, code: str, df: pd.DataFrame) -> None:
+        """Caches the DataFrame parsed from an ETF's newly downloaded file."""
+        entry = self.pending.pop(code)
+        entry["frame"] = os.path.join(self.cache_dir, "frames", f"{code}_{entry['date']}.pkl")
+        df.to_pickle(entry["frame"])
+        self._commit(code, entry)
+        self.frames[code] = df
+
+    def save(self) -> None:
+        """Writes the index, replacing the previous one only once it is complete."""
+        with open(f"{self.index_path}.tmp", "w") as index_file:
+            json.dump(self.index, index_file, indent=2)
+        os.replace(f"{self.index_path}.tmp", self.index_path)
+
+    def summary(self) -> str:
+        hits = self.stats["not modified"] + self.stats["same content"] + self.stats["same date"]
+        return (f"Cache: {hits} hits ({self.stats['not modified']} not modified, "
+                f"{self.stats['same content']} same content, {self.stats['same date']} same As of date), "
+                f"{self.stats['parsed']} misses")
+
+
+def benchmark_parsing(file_paths: Dict[str, str], workers: int) -> None:
+    """
+    Times parsing the Excel files with the two-read path, the single-pass path, and the single-pass
+    path across a process pool, checking that every path gives the same DataFrames.
+
+    Parameters:
+    - file_paths (Dict[str, str]): The Excel file path for each ETF code.
+    - workers (int): The number of worker processes.
+    """
+    def two_reads() -> Dict[str, pd.DataFrame]:
+        return {code: generate_dataframe(path, get_excel_metadata(path)) for code, path in file_paths.items()}
+
+    def single_pass() -> Dict[str, pd.DataFrame]:
+        return {code: parse_workbook(path) for code, path in file_paths.items()}
+
+    timings: List[Tuple[str, float]] = []
+    results: List[Dict[str, pd.DataFrame]] = []
+    for name, parse in [("two reads", two_reads), ("single pass", single_pass),
+                        (f"single pass, {workers} processes", lambda: parse_workbooks(file_paths, workers))]:
+        start = time.perf_counter()
+        results.append(parse())
+        timings.append((name, time.perf_counter() - start))
+    for result in results[1:]:
+        for code, df in result.items():
+            pd.testing.assert_frame_equal(df, results[0][code])
+    for name, seconds in timings:
+        print(f"{name:<26}: {seconds:7.3f}s for {len(file_paths)} files ({timings[0][1] / seconds:.1f}x)")
+
+
+def upsert_holdings(store_dir: str, df: pd.DataFrame) -> int:
+    """
+    Writes holdings into a Parquet dataset partitioned by Date and Ticker Symbol. Each (Date, ETF)
+    is one file that is replaced as a whole, so writing the same holdings again changes nothing. Every
+    file has the same type per column, whatever the values of its partition.
+
+    Parameters:
+    - store_dir (str): The root directory of the dataset.
+    - df (pd.DataFrame): The holdings, with Date and Ticker Symbol columns.
+
+    Returns:
+    - int: The number of (Date, ETF) partitions written.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    df = df.drop(columns=STORE_PARTITIONS).apply(
+        lambda column: pd.to_numeric(column, errors="coerce").astype("float64")
+        if column.name in STORE_NUMERIC_COLUMNS else column.map(str, na_action="ignore").astype("string")
+    ).join(df[STORE_PARTITIONS])
+    schema = pa.schema([(column, pa.float64() if column in STORE_NUMERIC_COLUMNS else pa.string())
+                        for column in df.columns if column not in STORE_PARTITIONS])
+    partitions = 0
+    for (date, ticker), group in df.groupby(STORE_PARTITIONS, sort=False):
+        partition_dir = os.path.join(store_dir, f"Date={date}", f"Ticker Symbol={ticker}")
+        os.makedirs(partition_dir, exist_ok=True)
+        file_path = os.path.join(partition_dir, "holdings.parquet")
+        table = pa.Table.from_pandas(group.drop(columns=STORE_PARTITIONS), schema=schema, preserve_index=False)
+        pq.write_table(table, f"{file_path}.tmp")
+        # Readers see either the previous file or the complete new one.
+        os.replace(f"{file_path}.tmp", file_path)
+        partitions += 1
+    return partitions
+
+
+def query_holdings(store_dir: str, etfs: Optional[Sequence[str]] = None, start_date: Optional[str] = None,
+                   end_date: Optional[str] = None, tickers: Optional[Sequence[str]] = None,
+                   columns: Optional[Sequence[str]] = None) -> pd.DataFrame:
+    """
+    Reads holdings from the Parquet dataset, opening only the partitions of the requested dates and
+    ETFs and only the requested columns.
+
+    Parameters:
+    - store_dir (str): The root directory of the dataset.
+    - etfs (Sequence[str], optional): The ETF ticker symbols to read, all if not given.
+    - start_date (str, optional): The first date to read, as YYYY-MM-DD.
+    - end_date (str, optional): The last date to read, as YYYY-MM-DD.
+    - tickers (Sequence[str], optional): The holding tickers to keep, all if not given.
+    - columns (Sequence[str], optional): The holdings columns to read besides Date and Ticker Symbol.
+
+    Returns:
+    - pd.DataFrame: The holdings, sorted by Date and Ticker Symbol.
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    partitioning = ds.partitioning(pa.schema([(name, pa.string()) for name in STORE_PARTITIONS]), flavor="hive")
+    dataset = ds.dataset(store_dir, format="parquet", partitioning=partitioning)
+    conditions = []
+    if etfs is not None:
+        conditions.append(ds.field("Ticker Symbol").isin(list(etfs)))
+    if start_date is not None:
+        conditions.append(ds.field("Date") >= start_date)
+    if end_date is not None:
+        conditions.append(ds.field("Date") <= end_date)
+    if tickers is not None:
+        conditions.append(ds.field("Ticker").isin(list(tickers)))
+    row_filter = None
+    for condition in conditions:
+        row_filter = condition if row_filter is None else row_filter & condition
+    if columns is not None:
+        columns = STORE_PARTITIONS + [column for column in columns if column not in STORE_PARTITIONS]
+    df = dataset.to_table(columns=columns, filter=row_filter).to_pandas()
+    return df.sort_values(STORE_PARTITIONS, kind="stable", ignore_index=True)
+
+
+def import_snapshots(store_dir: str, result_dir: str) -> None:
+    """
+    Upserts the holdings of every CSV snapshot in the result directory into the Parquet dataset,
+    oldest first, so that the latest snapshot of each (Date, ETF) wins.
+
+    Parameters:
+    - store_dir (str): The root directory of the dataset.
+    - result_dir (str): The directory of the "ETF Holdings" CSV snapshots.
+    """
+    snapshot_paths = sorted(glob.glob(os.path.join(result_dir, "ETF Holdings *.csv")))
+    for snapshot_path in snapshot_paths:
+        upsert_holdings(store_dir, pd.read_csv(snapshot_path, dtype={column: str for column in IDENTIFIER_COLUMNS}))
+    print(f"Imported {len(snapshot_paths)} snapshots into {store_dir}")
+
+
+def benchmark_query(store_dir: str, result_dir: str, etf: str, ticker: str) -> None:
+    """
+    Times reading the weight history of one holding of one ETF from the Parquet dataset against
+    scanning every CSV snapshot, checking that both give the same history.
+
+    Parameters:
+    - store_dir (str): The root directory of the dataset.
+    - result_dir (str): The directory of the "ETF Holdings" CSV snapshots.
+    - etf (str): The ETF ticker symbol.
+    - ticker (str): The holding ticker.
+    """
+    start = time.perf_counter()
+    snapshots = [pd.read_csv(path) for path in sorted(glob.glob(os.path.join(result_dir, "ETF Holdings *.csv")))]
+    csv_df = pd.concat(snapshots, ignore_index=True)
+    csv_df = csv_df.loc[(csv_df["Ticker Symbol"] == etf) & (csv_df["Ticker"] == ticker), ["Date", "Weight"]]
+    # Several snapshots can hold the same date; the latest one counts.
+    csv_df = csv_df.drop_duplicates("Date", keep="last").sort_values("Date", ignore_index=True)
+    csv_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    store_df = query_holdings(store_dir, etfs=[etf], tickers=[ticker], columns=["Weight"])
+    store_seconds = time.perf_counter() - start
+
+    pd.testing.assert_frame_equal(store_df[["Date", "Weight"]], csv_df, check_dtype=False)
+    print(f"{etf} {ticker}: {len(store_df)} dates")
+    print(f"CSV snapshots ({len(snapshots)} files): {csv_seconds:7.3f}s")
+    print(f"Parquet store              : {store_seconds:7.3f}s ({csv_seconds / store_seconds:.1f}x)")
+
+
 if __name__ == "__main__":
+    # Define Arguments
+    parser = argparse.ArgumentParser(description="Download the SPDR ETF holdings workbooks and combine them into a CSV")
+    parser.add_argument("-w", "--workers", type=int, default=4,
+                        help="Maximum number of concurrent downloads")
+    parser.add_argument("-r", "--retries", type=int, default=3,
+                        help="Number of retries of a failed download")
+    parser.add_argument("--backoff", type=float, default=1.0,
+                        help="Seconds before the first retry of a download, doubled before each further one")
+    parser.add_argument("--skip_failed", action="store_true",
+                        help="Skip the ETFs whose download still fails after the retries, exiting with status 1 "
+                             "once the others are written, instead of stopping at the first failure")
+    parser.add_argument("--base_url",
+                        help="Download the workbooks by file name from this URL instead of SSGA, "
+                             "e.g. a local HTTP server serving fixture files")
+    parser.add_argument("-p", "--processes", type=int, default=os.cpu_count(),
+                        help="Number of processes parsing the workbooks")
+    parser.add_argument("--bench_parse", action="store_true",
+                        help="Benchmark parsing the downloaded workbooks with two reads against a single pass, "
+                             "without writing results")
+    parser.add_argument("-c", "--cache_dir",
+                        help="Keep the downloaded workbooks and their parsed DataFrames in this directory, "
+                             "only downloading changed workbooks and only parsing new As of dates")
+    parser.add_argument("-o", "--output", choices=["csv", "parquet", "both"], default="csv",
+                        help="Write a timestamped CSV snapshot, upsert into the Parquet holdings store, or both")
+    parser.add_argument("--store_dir", default="ETF_ExcelToCSV.Store",
+                        help="Root directory of the Parquet holdings store, partitioned by Date and Ticker Symbol")
+    parser.add_argument("--import_snapshots", action="store_true",
+                        help="Only upsert every CSV snapshot of the results directory into the store, and exit")
+    parser.add_argument("--bench_query", nargs=2, metavar=("ETF", "TICKER"),
+                        help="Only benchmark reading the weight history of TICKER in ETF from the store "
+                             "against scanning the CSV snapshots, and exit")
+    args = parser.parse_args()
     # Setup directories for downloading and storing results.
     download_dir = 'ETF_ExcelToCSV.TempDownloads'
     result_dir = 'ETF_ExcelToCSV.Results'
+    if args.import_snapshots:
+        import_snapshots(args.store_dir, result_dir)
+        raise SystemExit(0)
+    if args.bench_query:
+        benchmark_query(args.store_dir, result_dir, *args.bench_query)
+        raise SystemExit(0)
+    cache = DownloadCache(args.cache_dir) if args.cache_dir else None
     # Create the download directory, failing if it already exists.
-    os.makedirs(download_dir, exist_ok=True)
+    if cache is None:
+        os.makedirs(download_dir, exist_ok=True)
     # Get the current date for naming purposes.
     run_date = datetime.datetime.now().strftime("%Y-%m-%d")
     run_time = datetime.datetime.now().strftime("%H%M%S")
     # Initialize a list to hold DataFrames for each ETF.
     dataframe_list = []
-    # Iterate over the ETFs, download, and process each file.
-    for code, data in ETF_Download_Links.items():
-        download_path = download_file(data["Link"], download_dir, f"{code}_{run_date}")
-        if download_path == "":
-            print(f"Failed to download file for {code}")
-            continue
-        metadata = get_excel_metadata(download_path)
-        parsed_df = generate_dataframe(download_path, metadata)
-        dataframe_list.append(parsed_df)
-        print(f"Successfully parsed file for {code}")
-    # Clean up the download directory.
-    shutil.rmtree(download_dir)
+    # Download all the ETF files at once.
+    download_links = {
+        code: f"{args.base_url.rstrip('/')}/{os.path.basename(data['Link'])}" if args.base_url else data["Link"]
+        for code, data in ETF_Download_Links.items()
+    }
+    download_paths = download_files(download_links, download_dir, run_date, args.workers, args.retries, args.backoff,
+                                    cache, args.skip_failed)
+    failed_codes = [code for code, download_path in download_paths.items() if download_path == ""]
+    for code in failed_codes:
+        print(f"Failed to download file for {code}")
+    downloaded_paths = {code: path for code, path in download_paths.items() if path != ""}
+    if not downloaded_paths:
+        print("No file was downloaded")
+        if cache is None:
+            shutil.rmtree(download_dir)
+        raise SystemExit(1)
+    if args.bench_parse:
+        benchmark_parsing(downloaded_paths, args.processes)
+        if cache is None:
+            shutil.rmtree(download_dir)
+        else:
+            cache.save()
+        raise SystemExit(1 if failed_codes else 0)
+    # Parse the files not in the cache in parallel, each in a single pass.
+    cached_frames = cache.frames if cache is not None else {}
+    parse_paths = {code: path for code, path in downloaded_paths.items() if code not in cached_frames}
+    parsed_frames = parse_workbooks(parse_paths, args.processes) if parse_paths else {}
+    for code in downloaded_paths:
+        if code in parsed_frames:
+            if cache is not None:
+                cache.store_frame(code, parsed_frames[code])
+            dataframe_list.append(parsed_frames[code])
+            print(f"Successfully parsed file for {code}")
+        else:
+            dataframe_list.append(cached_frames[code])
+            print(f"Reused cached data for {code}")
+    if cache is None:
+        # Clean up the download directory.
+        shutil.rmtree(download_dir)
+    else:
+        cache.save()
+        print(cache.summary())
     # Concatenate all DataFrames into a single DataFrame.
     result_df = pd.concat(dataframe_list, ignore_index=True)
-    # Ensure the result directory exists.
-    if not os.path.exists(result_dir):
-        os.makedirs(result_dir)
-    # Save the concatenated DataFrame to a CSV file.
-    result_df.to_csv(os.path.join(result_dir, f'ETF Holdings {run_date}_{run_time}.csv'), index=False)
+    if args.output in ("parquet", "both"):
+        # Replace the holdings of each (Date, ETF) in the store.
+        partitions = upsert_holdings(args.store_dir, result_df)
+        print(f"Upserted {partitions} (Date, ETF) partitions into {args.store_dir}")
+    if args.output in ("csv", "both"):
+        # Ensure the result directory exists.
+        if not os.path.exists(result_dir):
+            os.makedirs(result_dir)
+        # Save the concatenated DataFrame to a CSV file.
+        result_df.to_csv(os.path.join(result_dir, f'ETF Holdings {run_date}_{run_time}.csv'), index=False)
+    # Skipped downloads still fail the run, once the other ETFs are written.
+    if failed_codes:
+        print(f"Skipped {len(failed_codes)} of {len(download_paths)} ETFs: {', '.join(failed_codes)}")
+        raise SystemExit(1)
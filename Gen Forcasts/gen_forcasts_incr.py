@@ -1,11 +1,23 @@
 #!/usr/bin/env python3
 
 import argparse
+import atexit
+import csv
+import json
+import mmap
+import os
+import shlex
+import shutil
 import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict, deque
 from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from pathlib import Path
-from threading import Lock
-from typing import List
+from threading import BoundedSemaphore, Lock, Thread
+from typing import Deque, Dict, Iterable, List, Optional, TextIO, Tuple
+import numpy as np
 from tqdm import tqdm
 
 # Argument parser setup
@@ -37,13 +49,92 @@ parser.add_argument(
     default=8,
     help="Maximum number of processes to run concurrently",
 )
+parser.add_argument(
+    "-g",
+    "--generator",
+    help="Command of a long-lived incremental generator, started once per file and model "
+    "with the model appended; it reads bars on stdin and writes one forecast line per bar "
+    "to stdout. Without it --generator_bin is rerun over the whole temp file for every row",
+)
+parser.add_argument(
+    "--generator_bin",
+    default=os.environ.get(
+        "FDI_SIGNAL_GENERATOR",
+        "/home/EAGLERD/gils/fdi.git/FDISignalGeneratorCpp1.0.1.20/FDISignalGenerator",
+    ),
+    help="Command of the FDISignalGenerator rerun for every row, called as "
+    "`<command> <bars csv> <output csv> <model> False` (default: $FDI_SIGNAL_GENERATOR, "
+    "else the FDISignalGeneratorCpp build)",
+)
+parser.add_argument(
+    "-b",
+    "--batch_size",
+    type=int,
+    default=64,
+    help="Number of bars sent to an incremental generator at once",
+)
+parser.add_argument(
+    "-w",
+    "--window",
+    type=int,
+    default=0,
+    help="Schedule rows of all files on one saturated process pool, with up to this many "
+    "rows in flight per file (each slot of the window keeping its own copy of the temp file). "
+    "0 keeps the per-file row barrier",
+)
+parser.add_argument(
+    "-l",
+    "--lookback",
+    type=int,
+    default=0,
+    help="Hand the generator only the last this many bars, rewritten for every row into a "
+    "window file in --lookback_dir, instead of the whole growing temp file (incremental "
+    "generators are warmed up on this many bars). A header line detected at the top of the "
+    "bar file stays at the top of every window. 0 keeps the full history",
+)
+parser.add_argument(
+    "--lookback_dir",
+    default="/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+    help="Directory, preferably on tmpfs, of the lookback window files and generator outputs",
+)
+parser.add_argument(
+    "--bench_io",
+    type=int,
+    default=0,
+    metavar="ROWS",
+    help="Only benchmark the bytes written per row with the full history against --lookback "
+    "on this many rows of every file, and exit",
+)
+parser.add_argument(
+    "--metrics",
+    help="Append per-stage timings (queue wait, generator, append, fsync) of every file, model "
+    "and row to this JSONL file, and print a throughput and latency summary at the end",
+)
+parser.add_argument(
+    "--bars_dir",
+    default=r"/home/EAGLERD/gils/crypt/Bars",
+    help="Directory of the intraday bar files",
+)
+parser.add_argument(
+    "--forecasts_dir",
+    default=r"/home/EAGLERD/gils/crypt/Forecasts/Incr",
+    help="Directory of the incremental forecast files",
+)
 args = parser.parse_args()
 
 # Define directories
-INTRADAY_DIR = Path(r"/home/EAGLERD/gils/crypt/Bars")
+INTRADAY_DIR = Path(args.bars_dir)
 INCREMENTAL_TEMP_DATA_DIR = INTRADAY_DIR / "Temp"
-INCREMENTAL_MATS_DIR = Path(r"/home/EAGLERD/gils/crypt/Forecasts/Incr")
+INCREMENTAL_MATS_DIR = Path(args.forecasts_dir)
 INCREMENTAL_MATS_TEMP_DIR = INCREMENTAL_MATS_DIR / "Temp"
+# Snapshot slots and outputs of the pipelined scheduler
+ROW_SNAPSHOT_DIR = INCREMENTAL_TEMP_DATA_DIR / "Rows"
+ROW_OUTPUT_DIR = INCREMENTAL_MATS_TEMP_DIR / "Rows"
+# Progress journals of committed rows
+JOURNAL_DIR = INCREMENTAL_MATS_DIR / "Journal"
+# Newline-offset indexes of the bar files
+INDEX_DIR = INTRADAY_DIR / "Index"
+FDI_SIGNAL_GENERATOR: str = args.generator_bin
 
 # Parameters
 MODELS = ["FDS2", "FDS1"]
@@ -51,6 +142,20 @@ TIME_FRAMES = args.time_frames
 SKIP_ROWS: int = args.skip_rows
 CONTINUE_PREV: bool = args.continue_prev
 MAX_PROCESSES: int = args.max_processes
+GENERATOR: str = args.generator
+BATCH_SIZE: int = args.batch_size
+WINDOW: int = args.window
+LOOKBACK: int = args.lookback
+# Per-run directory of the lookback windows, created in main
+lookback_dir: Optional[Path] = None
+# Bytes at the start of a bar file sniffed for a header line
+HEADER_SNIFF_BYTES = 64 << 10
+# Bytes of a bar file scanned for newlines at once
+INDEX_SCAN_BYTES = 64 << 20
+# Commits between syncs of the data files, which bound the journal to this many records
+CHECKPOINT_COMMITS = 1000
+# Stage timings of the run, created in main when --metrics is given
+metrics: Optional["StageMetrics"] = None
 
 lock = Lock()
 
@@ -83,25 +188,298 @@ def create_or_clean_directory(
                 file.unlink()
 
 
-def init_temp_file(intraday_file: str, rows: int = 1) -> bool:
-    """Move the specified number of lines from the buffer file to the temp file."""
+class StageMetrics:
+    """
+    Timings of the stages of every (file, model, row), one JSON record per line.
+
+    Stages are `queue` (submitted until a worker or generator slot takes it), `generator`
+    (subprocess or batch wall time), `append` (write and flush) and `fsync`. Commits, which
+    write the bars and the forecasts of every model at once, are recorded under the model
+    `bars`; a batch of rows gives one record with its first row and row count.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.writer = path.open("a")
+        self.lock = Lock()
+        self.start = time.perf_counter()
+        self.seconds: Dict[str, List[float]] = defaultdict(list)
+        self.file_rows: Dict[str, int] = defaultdict(int)
+        self.file_end: Dict[str, float] = {}
+
+    def record(self, file_name: str, model: str, row: int, stage: str, seconds: float, rows: int = 1) -> None:
+        now = time.perf_counter()
+        with self.lock:
+            self.writer.write(
+                json.dumps(
+                    {
+                        "time": round(now - self.start, 6),
+                        "file": file_name,
+                        "model": model,
+                        "row": row,
+                        "rows": rows,
+                        "stage": stage,
+                        "seconds": round(seconds, 6),
+                    }
+                )
+                + "\n"
+            )
+            self.seconds[stage].append(seconds)
+            if model == "bars" and stage == "fsync":
+                self.file_rows[file_name] += rows
+                self.file_end[file_name] = now
+
+    def summary(self, workers: int) -> None:
+        """Print rows/s per file, latency percentiles per stage and generator worker utilization."""
+        self.writer.close()
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        for file_name, rows in sorted(self.file_rows.items()):
+            tqdm.write(f"{file_name:<26}: {rows / max(self.file_end[file_name] - self.start, 1e-9):10.1f} rows/s")
+        for stage in ("queue", "generator", "append", "fsync"):
+            if not self.seconds[stage]:
+                continue
+            p50, p95, p99 = np.percentile(self.seconds[stage], [50, 95, 99]) * 1000
+            tqdm.write(
+                f"{stage:<10}: {len(self.seconds[stage]):8} records, "
+                f"p50 {p50:9.2f} ms, p95 {p95:9.2f} ms, p99 {p99:9.2f} ms"
+            )
+        tqdm.write(
+            f"Workers   : {sum(self.seconds['generator']) / (elapsed * workers):.1%} utilization "
+            f"of {workers} over {elapsed:.1f}s"
+        )
+
+
+def newline_ends(path: Path, start: int = 0, end: Optional[int] = None) -> np.ndarray:
+    """Byte offsets just past every newline of path[start:end], scanned through a memory map."""
+    size = path.stat().st_size if end is None else end
+    if size <= start:
+        return np.empty(0, dtype=np.uint64)
+    ends = []
+    with path.open("rb") as reader, mmap.mmap(reader.fileno(), size, access=mmap.ACCESS_READ) as data:
+        for chunk_start in range(start, size, INDEX_SCAN_BYTES):
+            chunk = np.frombuffer(data, dtype=np.uint8, count=min(INDEX_SCAN_BYTES, size - chunk_start), offset=chunk_start)
+            ends.append(np.flatnonzero(chunk == ord("\n")).astype(np.uint64) + (chunk_start + 1))
+            # Drop the view before the map closes
+            del chunk
+    return np.concatenate(ends)
+
+
+class BarIndex:
+    """
+    Persistent newline-offset index of an append-only intraday bar file.
+
+    Index/<file>.idx holds the byte offset just past every complete line, as uint64.
+    Opening the index scans only the bytes appended since it was last written, so row
+    counts and the byte offset of any row come without reading the bar file. The index
+    is rebuilt from scratch if the file was rewritten rather than appended to.
+    """
+
+    def __init__(self, file_name: str) -> None:
+        self.source_file = INTRADAY_DIR / file_name
+        self.index_file = INDEX_DIR / f"{file_name}.idx"
+        self.ends = self._load()
+        self.size = self.source_file.stat().st_size
+        new_ends = newline_ends(self.source_file, self.offset(len(self.ends)), self.size)
+        if len(new_ends):
+            INDEX_DIR.mkdir(parents=True, exist_ok=True)
+            with self.index_file.open("ab") as index_writer:
+                new_ends.tofile(index_writer)
+            self.ends = np.concatenate([self.ends, new_ends])
+        # A last line without its newline yet still counts as a row
+        self.rows = len(self.ends) + (self.offset(len(self.ends)) < self.size)
+
+    def _load(self) -> np.ndarray:
+        """Read the stored offsets, or none if they no longer match the bar file."""
+        if not self.index_file.exists():
+            return np.empty(0, dtype=np.uint64)
+        ends = np.fromfile(self.index_file, dtype=np.uint64)
+        if self.index_file.stat().st_size % ends.itemsize:
+            # Torn last entry of an interrupted update
+            with self.index_file.open("ab") as index_writer:
+                index_writer.truncate(len(ends) * ends.itemsize)
+        if len(ends) and not (self._is_line_end(int(ends[0])) and self._is_line_end(int(ends[-1]))):
+            self.index_file.unlink()
+            return np.empty(0, dtype=np.uint64)
+        return ends
+
+    def _is_line_end(self, offset: int) -> bool:
+        """Whether the bar file has a newline just before `offset`."""
+        with self.source_file.open("rb") as reader:
+            reader.seek(offset - 1)
+            return reader.read(1) == b"\n"
+
+    def offset(self, row: int) -> int:
+        """Byte offset at which source row `row` (0-based) starts; the file size past the last row."""
+        if row <= 0:
+            return 0
+        if row > len(self.ends):
+            return self.size
+        return int(self.ends[row - 1])
+
+
+def init_temp_file(intraday_file: str, index: BarIndex, rows: int = 1) -> int:
+    """
+    Move the specified number of lines from the buffer file to the temp file.
+    Returns the source byte offset after the copied lines.
+    """
     source_path = INTRADAY_DIR / intraday_file
     temp_file = INCREMENTAL_TEMP_DATA_DIR / intraday_file
 
-    with source_path.open("r") as source_reader, temp_file.open("w") as temp_writer:
-        for _ in range(rows):
-            line = source_reader.readline()
-            if not line:
-                return False
-            temp_writer.write(line)
+    source_offset = index.offset(rows)
+    with source_path.open("rb") as source_reader, temp_file.open("wb") as temp_writer:
+        temp_writer.write(source_reader.read(source_offset))
+    return source_offset
+
+
+def fsync_path(path: Path) -> None:
+    """Flush a file (or directory) to disk."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class FileJournal:
+    """
+    Durable progress of one intraday file: the temp bars and each model's Incr file.
+
+    A commit appends the bars of its rows to the temp file and their forecast lines to
+    the Incr files without syncing them, then appends one record holding those same lines
+    and the new source offset to an append-only journal, the only file fsynced per commit.
+    Every CHECKPOINT_COMMITS commits, and on close, the data files are fsynced and the
+    journal is replaced by a base record of their sizes. On resume the data files are cut
+    back to the base sizes and the journaled lines written again, so every forecast line
+    is written exactly once without counting any lines.
+    """
+
+    def __init__(self, file_name: str, models: List[str]) -> None:
+        base_name = Path(file_name).stem
+        self.temp_file = INCREMENTAL_TEMP_DATA_DIR / file_name
+        self.final_files = {
+            model: INCREMENTAL_MATS_DIR / f"{base_name}x{model}.csv" for model in models
+        }
+        self.journal_file = JOURNAL_DIR / f"{base_name}.journal"
+        self.rows = 0
+        self.source_offset = 0
+        self.commits = 0
+        # Committed sizes of the temp and Incr files, and the bars appended since the last commit
+        self.sizes: List[int] = []
+        self.bars: List[str] = []
+        self.writers: Dict[Path, TextIO] = {}
+        self.append_seconds = self.fsync_seconds = 0.0
 
-    return True
+    def exists(self) -> bool:
+        return self.journal_file.exists() and self.journal_file.stat().st_size > 0
+
+    def _data_files(self) -> List[Path]:
+        return [self.temp_file, *self.final_files.values()]
+
+    def _write_base(self) -> None:
+        """Replace the journal by a base record of the committed (and already synced) data file sizes."""
+        record = json.dumps({"rows": self.rows, "source_offset": self.source_offset, "sizes": self.sizes})
+        temp_path = self.journal_file.with_suffix(".tmp")
+        with temp_path.open("w") as journal_writer:
+            journal_writer.write(record + "\n")
+            journal_writer.flush()
+            os.fsync(journal_writer.fileno())
+        os.replace(temp_path, self.journal_file)
+        fsync_path(JOURNAL_DIR)
+        self.commits = 0
+
+    def start(self, rows: int, source_offset: int) -> None:
+        """Start a new journal for a temp file just initialized with `rows` source rows."""
+        JOURNAL_DIR.mkdir(parents=True, exist_ok=True)
+        self.rows = rows
+        self.source_offset = source_offset
+        self.sizes = [path.stat().st_size if path.exists() else 0 for path in self._data_files()]
+        for path in self._data_files():
+            if path.exists():
+                fsync_path(path)
+        self._write_base()
+
+    def resume(self) -> None:
+        """Cut the data files back to the base record and write the journaled rows again."""
+        data = self.journal_file.read_bytes()
+        # A torn last record was never acknowledged, so it is dropped
+        records = [json.loads(line) for line in data[: data.rfind(b"\n") + 1].splitlines()]
+        base, commits = records[0], records[1:]
+        self.sizes = []
+        for i, (path, size) in enumerate(zip(self._data_files(), base["sizes"])):
+            with path.open("ab") as writer:
+                writer.truncate(size)
+                for commit in commits:
+                    writer.write(commit["lines"][i].encode())
+                writer.flush()
+                os.fsync(writer.fileno())
+                # Not tell(): an append handle keeps its position from before the truncate
+                self.sizes.append(os.fstat(writer.fileno()).st_size)
+        last = records[-1]
+        self.rows = last["rows"]
+        self.source_offset = last["source_offset"]
+        self._write_base()
+
+    def open(self) -> None:
+        for path in [*self._data_files(), self.journal_file]:
+            self.writers[path] = path.open("a", newline="")
+
+    def _write(self, path: Path, data: str) -> None:
+        start = time.perf_counter()
+        self.writers[path].write(data)
+        self.writers[path].flush()
+        self.append_seconds += time.perf_counter() - start
+
+    def _fsync(self, path: Path) -> None:
+        start = time.perf_counter()
+        os.fsync(self.writers[path].fileno())
+        self.fsync_seconds += time.perf_counter() - start
+
+    def append_bars(self, bars: List[str]) -> None:
+        """Append the bars of the next commit to the temp file, for the generators to read."""
+        self._write(self.temp_file, "".join(bars))
+        self.bars.extend(bars)
+
+    def commit(self, forecasts: Dict[str, List[str]]) -> None:
+        """Append each model's forecasts of the appended bars to its Incr file and journal them."""
+        lines = ["".join(self.bars)] + ["".join(forecasts[model]) for model in self.final_files]
+        for path, data in zip(self.final_files.values(), lines[1:]):
+            self._write(path, data)
+        first_row, rows = self.rows, len(self.bars)
+        self.rows += rows
+        self.source_offset += sum(len(bar.encode()) for bar in self.bars)
+        self.bars = []
+        self.sizes = [os.fstat(self.writers[path].fileno()).st_size for path in self._data_files()]
+        record = {"rows": self.rows, "source_offset": self.source_offset, "lines": lines}
+        self._write(self.journal_file, json.dumps(record) + "\n")
+        self._fsync(self.journal_file)
+        self.commits += 1
+        if self.commits >= CHECKPOINT_COMMITS:
+            self.checkpoint()
+        if metrics:
+            metrics.record(self.temp_file.name, "bars", first_row, "append", self.append_seconds, rows)
+            metrics.record(self.temp_file.name, "bars", first_row, "fsync", self.fsync_seconds, rows)
+        self.append_seconds = self.fsync_seconds = 0.0
+
+    def checkpoint(self) -> None:
+        """Sync the data files and start the journal over from their sizes."""
+        for path in self._data_files():
+            self._fsync(path)
+        self.writers.pop(self.journal_file).close()
+        self._write_base()
+        self.writers[self.journal_file] = self.journal_file.open("a", newline="")
+
+    def close(self) -> None:
+        # Bars appended without a commit (a failed row) stay past the base sizes, to be cut on resume
+        if self.writers and self.commits:
+            self.checkpoint()
+        for writer in self.writers.values():
+            writer.close()
+        self.writers.clear()
 
 
 def process_intraday_file(
     thread_index: int,
     file_name: str,
-    start_index: int,
+    journal: FileJournal,
     models: List[str],
     process_executor: ProcessPoolExecutor,
 ) -> int:
@@ -112,46 +490,462 @@ def process_intraday_file(
     base_name = Path(file_name).stem
     source_file = INTRADAY_DIR / file_name
     temp_file = INCREMENTAL_TEMP_DATA_DIR / file_name
-    futures: List[Future] = []
+    output_dir = INCREMENTAL_MATS_TEMP_DIR
+    if LOOKBACK:
+        # The generator reads a bounded window on tmpfs instead of the growing temp file
+        header = bars_header(file_name)
+        lookback: Deque[str] = deque(last_lines(temp_file, LOOKBACK), maxlen=LOOKBACK)
+        temp_file = lookback_dir / file_name
+        output_dir = lookback_dir
+    futures: Dict[str, Future] = {}
     buffer = 0
-    with source_file.open("r") as source_reader, temp_file.open("a") as temp_writer:
-        for index, line in enumerate(source_reader):
-            if index < start_index:
-                continue
+    journal.open()
+    with source_file.open("r", newline="") as source_reader:
+        source_reader.seek(journal.source_offset)
+        for line in iter(source_reader.readline, ""):
             # Append the line to the temp file
-            temp_writer.write(line)
-            temp_writer.flush()
+            row = journal.rows
+            journal.append_bars([line])
+            if LOOKBACK:
+                lookback.append(line)
+                write_lookback(temp_file, lookback_bars(header, lookback, row + 1))
 
             # For each model, construct and run the command
             for model in models:
-                fds_outfile = f"{base_name}x{model}.csv"
-                temp_output_file = INCREMENTAL_MATS_TEMP_DIR / fds_outfile
-                final_output_file = INCREMENTAL_MATS_DIR / fds_outfile
-
-                command = "/home/EAGLERD/gils/fdi.git/FDISignalGeneratorCpp1.0.1.20/FDISignalGenerator {} {} {} False; tail -1 {} >> {}".format(
-                    INCREMENTAL_TEMP_DATA_DIR / file_name,
-                    temp_output_file,
-                    model,
-                    temp_output_file,
-                    final_output_file,
+                temp_output_file = output_dir / f"{base_name}x{model}.csv"
+                futures[model] = process_executor.submit(
+                    run_generator_row, temp_file, temp_output_file, model, time.time()
                 )
-                future = process_executor.submit(run_command, command)
-                futures.append(future)
 
             # Wait for all submitted commands to complete
-            wait(futures, return_when="ALL_COMPLETED")
+            wait(futures.values(), return_when="ALL_COMPLETED")
+            for model, future in futures.items():
+                record_generator_row(file_name, model, row, future.result())
+            journal.commit({model: [future.result()[0]] for model, future in futures.items()})
             if buffer != 0 and buffer % 25 == 0:
                 increment_progress(thread_index, buffer)
                 buffer = 1
             else:
                 buffer += 1
             futures.clear()
+    journal.close()
     increment_progress(thread_index, buffer)
     progress_complete(thread_index)
     return thread_index
 
 
+def last_lines(path: Path, count: int) -> List[str]:
+    """Return up to the last `count` lines of a file, like `tail -n` (none if the file is missing)."""
+    try:
+        with path.open("rb") as reader:
+            size = reader.seek(0, os.SEEK_END)
+            block = 4096
+            while True:
+                reader.seek(max(size - block, 0))
+                lines = reader.read().splitlines(keepends=True)
+                if len(lines) > count or block >= size:
+                    return [line.decode() for line in lines[-count:]] if count else []
+                block *= 2
+    except FileNotFoundError:
+        return []
+
+
+def last_line(path: Path) -> str:
+    """Return the last line of a file, like `tail -1` (empty if the file is missing or empty)."""
+    lines = last_lines(path, 1)
+    return lines[0] if lines else ""
+
+
+def bars_header(file_name: str) -> str:
+    """
+    Return the header line of a bar file, or "" if csv.Sniffer finds none. The temp file
+    starts with the first rows of the bar file, so the generator always sees the header at
+    the top of the history; a lookback window has to keep it there too.
+    """
+    with (INTRADAY_DIR / file_name).open("r", newline="") as reader:
+        sample = reader.read(HEADER_SNIFF_BYTES)
+    if len(sample) == HEADER_SNIFF_BYTES:
+        # Only whole lines, so the sniffer does not see a cut off last row
+        sample = sample[: sample.rfind("\n") + 1]
+    if not sample:
+        return ""
+    try:
+        has_header = csv.Sniffer().has_header(sample)
+    except csv.Error:
+        has_header = False
+    return sample.splitlines(keepends=True)[0] if has_header else ""
+
+
+def lookback_bars(header: str, bars: Iterable[str], rows: int) -> List[str]:
+    """
+    Return the lookback window after `rows` rows: the last bars, after the header line once
+    it has slid out of them (while `rows` exceed the bars, the header is no longer among them).
+    """
+    bars = list(bars)
+    return [header] + bars if header and rows > len(bars) else bars
+
+
+def write_lookback(path: Path, bars: Iterable[str]) -> int:
+    """Rewrite a lookback window file with the given bars; returns the bytes written."""
+    with path.open("wb") as writer:
+        return writer.write("".join(bars).encode())
+
+
+def run_generator_row(
+    bars_file: Path, output_file: Path, model: str, submitted: float = 0.0
+) -> Tuple[str, float, float]:
+    """
+    Run the generator over a row snapshot; return the new forecast line, the wall time
+    and the time since `submitted` (a time.time()) the run waited for a worker. Raises
+    RuntimeError if the generator fails or writes no forecast, before the row is committed,
+    so that a resumed run retries it.
+    """
+    queued = time.time() - submitted if submitted else 0.0
+    start = time.perf_counter()
+    result = run_command(
+        "{} {} {} {} False".format(FDI_SIGNAL_GENERATOR, bars_file, output_file, model)
+    )
+    forecast = last_line(output_file)
+    output_file.unlink(missing_ok=True)
+    if result.returncode != 0 or not forecast:
+        raise RuntimeError(
+            f"Generator for {model} on {bars_file.name} exited with code {result.returncode}"
+            f"{'' if forecast else ' and wrote no forecast'}: {result.stderr.strip()}"
+        )
+    return forecast, time.perf_counter() - start, queued
+
+
+def record_generator_row(file_name: str, model: str, row: int, result: Tuple[str, float, float]) -> None:
+    """Record the queue wait and wall time of a generator run."""
+    if metrics:
+        metrics.record(file_name, model, row, "queue", result[2])
+        metrics.record(file_name, model, row, "generator", result[1])
+
+
+class FilePipeline:
+    """
+    Rows of one intraday file in flight on the shared process pool.
+
+    Row `row` runs on snapshot slot `row % window`, a copy of the temp file holding the
+    history plus every bar up to that row, so later rows can run before earlier ones
+    finish. A slot is copied from the temp file once and then only has the bars since its
+    previous row appended; that row was committed before the slot comes round again.
+    Rows are committed strictly in order: a row's bar is appended to the temp file, and
+    then its forecasts to the Incr files, only once every earlier row has been committed.
+    """
+
+    def __init__(
+        self, thread_index: int, file_name: str, journal: FileJournal, models: List[str], window: int
+    ) -> None:
+        self.thread_index = thread_index
+        self.file_name = file_name
+        self.models = models
+        self.journal = journal
+        self.row = journal.rows
+        self.temp_file = INCREMENTAL_TEMP_DATA_DIR / file_name
+        self.source_reader = (INTRADAY_DIR / file_name).open("r", newline="")
+        self.source_reader.seek(journal.source_offset)
+        journal.open()
+        self.exhausted = False
+        self.window = window
+        self.in_flight: Deque[Tuple[int, str, Dict[str, Future]]] = deque()
+        # Rows in each slot's copy of the temp file, and the bars of the last `window` rows
+        self.slot_rows: Dict[int, int] = {}
+        self.recent: Deque[str] = deque(maxlen=window)
+        self.snapshot_dir = ROW_SNAPSHOT_DIR
+        self.output_dir = ROW_OUTPUT_DIR
+        if LOOKBACK:
+            # Snapshots are bounded windows on tmpfs instead of copies of the whole history
+            self.header = bars_header(file_name)
+            self.lookback: Deque[str] = deque(last_lines(self.temp_file, LOOKBACK), maxlen=LOOKBACK)
+            self.snapshot_dir = self.output_dir = lookback_dir
+
+    def snapshot(self, slot: int) -> Path:
+        return self.snapshot_dir / f"{self.file_name}.{slot}"
+
+    def submit_next(self, process_executor: ProcessPoolExecutor) -> List[Future]:
+        """Submit the next row's model runs, unless the window is full or the file is done."""
+        if self.exhausted or len(self.in_flight) >= self.window:
+            return []
+        line = self.source_reader.readline()
+        if not line:
+            self.exhausted = True
+            return []
+        slot = self.row % self.window
+        snapshot = self.snapshot(slot)
+        self.recent.append(line)
+        if LOOKBACK:
+            self.lookback.append(line)
+            write_lookback(snapshot, lookback_bars(self.header, self.lookback, self.row + 1))
+        else:
+            if slot in self.slot_rows:
+                bars = list(self.recent)[self.slot_rows[slot] - self.row - 1 :]
+            else:
+                # The temp file holds the committed rows; the slot also needs those in flight
+                shutil.copyfile(self.temp_file, snapshot)
+                bars = [in_flight[1] for in_flight in self.in_flight] + [line]
+            with snapshot.open("a", newline="") as snapshot_writer:
+                snapshot_writer.write("".join(bars))
+            self.slot_rows[slot] = self.row + 1
+        futures = {
+            model: process_executor.submit(
+                run_generator_row,
+                snapshot,
+                self.output_dir / f"{Path(self.file_name).stem}x{model}.{self.row}.csv",
+                model,
+                time.time(),
+            )
+            for model in self.models
+        }
+        self.in_flight.append((self.row, line, futures))
+        self.row += 1
+        return list(futures.values())
+
+    def commit_ready(self) -> None:
+        """Commit the finished rows at the head of the window, in row order."""
+        while self.in_flight and all(future.done() for future in self.in_flight[0][2].values()):
+            row, line, futures = self.in_flight.popleft()
+            self.journal.append_bars([line])
+            for model, future in futures.items():
+                record_generator_row(self.file_name, model, row, future.result())
+            self.journal.commit({model: [future.result()[0]] for model, future in futures.items()})
+            increment_progress(self.thread_index, 1)
+
+    @property
+    def done(self) -> bool:
+        return self.exhausted and not self.in_flight
+
+    def close(self) -> None:
+        self.source_reader.close()
+        self.journal.close()
+        for slot in range(self.window):
+            self.snapshot(slot).unlink(missing_ok=True)
+
+
+def run_pipelined(
+    files: List[Tuple[int, str, FileJournal]],
+    models: List[str],
+    process_executor: ProcessPoolExecutor,
+    window: int,
+) -> None:
+    """
+    Keep the process pool saturated with rows from all files, at most `window` rows per
+    file in flight, and report pool utilization at the end.
+    """
+    ROW_SNAPSHOT_DIR.mkdir(parents=True, exist_ok=True)
+    ROW_OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    pipelines = [FilePipeline(*file, models, window) for file in files]
+    # Enough queued work to refill a worker the moment it frees up, without flooding the
+    # disk with snapshots
+    max_queued = 2 * MAX_PROCESSES
+    pending: Dict[Future, FilePipeline] = {}
+    busy_time = queued_time = 0.0
+    jobs = 0
+    start = time.perf_counter()
+    try:
+        while True:
+            # Round robin over the files so that none starves
+            submitted = True
+            while submitted and len(pending) + len(models) <= max_queued:
+                submitted = False
+                for pipeline in pipelines:
+                    if len(pending) + len(models) > max_queued:
+                        break
+                    for future in pipeline.submit_next(process_executor):
+                        pending[future] = pipeline
+                        submitted = True
+            if not pending:
+                break
+            wait_start = time.perf_counter()
+            done, _ = wait(pending, return_when="FIRST_COMPLETED")
+            queued_time += len(pending) * (time.perf_counter() - wait_start)
+            finished = {pending.pop(future) for future in done}
+            for future in done:
+                busy_time += future.result()[1]
+                jobs += 1
+            for pipeline in finished:
+                pipeline.commit_ready()
+                if pipeline.done:
+                    progress_complete(pipeline.thread_index)
+    finally:
+        for pipeline in pipelines:
+            pipeline.close()
+    elapsed = time.perf_counter() - start
+    tqdm.write(
+        f"Pool: {jobs} generator runs in {elapsed:.1f}s, "
+        f"utilization {busy_time / max(elapsed * MAX_PROCESSES, 1e-9):.1%} of {MAX_PROCESSES} workers, "
+        f"{queued_time / max(elapsed, 1e-9):.1f} runs queued or running on average"
+    )
+
+
+class IncrementalGenerator:
+    """A long-lived generator process for one file and model, fed bars through stdin."""
+
+    def __init__(self, command: str, model: str) -> None:
+        self.model = model
+        self.process = subprocess.Popen(
+            [*shlex.split(command), model],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+
+    def _write(self, bars: List[str]) -> None:
+        for bar in bars:
+            self.process.stdin.write(bar if bar.endswith("\n") else bar + "\n")
+        self.process.stdin.flush()
+
+    def forecast(self, bars: List[str]) -> List[str]:
+        """Send a batch of bars and return the forecast line of each."""
+        # Write from a second thread so a batch larger than the pipe buffers cannot deadlock
+        writer = Thread(target=self._write, args=(bars,))
+        writer.start()
+        lines = [self.process.stdout.readline() for _ in bars]
+        writer.join()
+        if not all(lines):
+            raise RuntimeError(
+                f"Generator for {self.model} exited with code {self.process.poll()} mid batch"
+            )
+        return lines
+
+    def close(self) -> None:
+        self.process.stdin.close()
+        self.process.wait()
+
+
+def forecast_batch(
+    batch: List[str],
+    journal: FileJournal,
+    generators: Dict[str, IncrementalGenerator],
+    slots: BoundedSemaphore,
+) -> None:
+    """Append a batch of bars to the temp file and each model's new forecasts to its Incr file."""
+    first_row = journal.rows
+    journal.append_bars(batch)
+    forecasts: Dict[str, List[str]] = {}
+    for model, generator in generators.items():
+        submitted = time.perf_counter()
+        with slots:
+            start = time.perf_counter()
+            forecasts[model] = generator.forecast(batch)
+        if metrics:
+            file_name = journal.temp_file.name
+            metrics.record(file_name, model, first_row, "queue", start - submitted, len(batch))
+            metrics.record(file_name, model, first_row, "generator", time.perf_counter() - start, len(batch))
+    journal.commit(forecasts)
+
+
+def process_intraday_file_incremental(
+    thread_index: int,
+    file_name: str,
+    journal: FileJournal,
+    models: List[str],
+    slots: BoundedSemaphore,
+) -> int:
+    """
+    Process a single intraday file in batches of bars through one long-lived
+    generator per model, appending each new forecast line to the model's Incr file.
+    """
+    source_file = INTRADAY_DIR / file_name
+    temp_file = INCREMENTAL_TEMP_DATA_DIR / file_name
+    generators: Dict[str, IncrementalGenerator] = {
+        model: IncrementalGenerator(GENERATOR, model) for model in models
+    }
+    # Warm the generators up on the bars already in the temp file; no forecasts are kept for them
+    if LOOKBACK:
+        history = lookback_bars(bars_header(file_name), last_lines(temp_file, LOOKBACK), journal.rows)
+    else:
+        with temp_file.open("r", newline="") as temp_reader:
+            history = temp_reader.readlines()
+    if history:
+        for generator in generators.values():
+            with slots:
+                generator.forecast(history)
+
+    journal.open()
+    try:
+        with source_file.open("r", newline="") as source_reader:
+            source_reader.seek(journal.source_offset)
+            batch: List[str] = []
+            for line in iter(source_reader.readline, ""):
+                batch.append(line)
+                if len(batch) == BATCH_SIZE:
+                    forecast_batch(batch, journal, generators, slots)
+                    increment_progress(thread_index, len(batch))
+                    batch = []
+            if batch:
+                forecast_batch(batch, journal, generators, slots)
+                increment_progress(thread_index, len(batch))
+    finally:
+        for generator in generators.values():
+            generator.close()
+        journal.close()
+    progress_complete(thread_index)
+    return thread_index
+
+
+def benchmark_temp_io(file_name: str, rows: int) -> None:
+    """
+    Run the generator over `rows` rows of a file after --skip_rows, once on the whole
+    growing history and once on a --lookback window, and print the bytes written per row
+    to disk and to the lookback directory in each mode.
+    """
+    index = BarIndex(file_name)
+    first_row = min(SKIP_ROWS, index.rows)
+    rows = min(rows, index.rows - first_row)
+    if rows <= 0:
+        return
+    with (INTRADAY_DIR / file_name).open("r", newline="") as source_reader:
+        bars = [source_reader.readline() for _ in range(first_row + rows)]
+    header = bars_header(file_name)
+    model = MODELS[0]
+    bench_dir = INCREMENTAL_TEMP_DATA_DIR / "Bench"
+    bench_dir.mkdir(parents=True, exist_ok=True)
+    history_file = bench_dir / file_name
+    for mode, size in (("full history", 0), (f"lookback {LOOKBACK}", LOOKBACK)):
+        write_lookback(history_file, bars[:first_row])
+        bars_file = lookback_dir / file_name if size else history_file
+        output_file = (lookback_dir if size else bench_dir) / f"{Path(file_name).stem}x{model}.csv"
+        disk_bytes = lookback_bytes = 0
+        start = time.perf_counter()
+        for row in range(first_row, first_row + rows):
+            # The temp file still gets every bar, as the durable record of committed rows
+            with history_file.open("ab") as history_writer:
+                disk_bytes += history_writer.write(bars[row].encode())
+            if size:
+                window = lookback_bars(header, bars[max(row + 1 - size, 0) : row + 1], row + 1)
+                lookback_bytes += write_lookback(bars_file, window)
+            run_command(
+                "{} {} {} {} False".format(FDI_SIGNAL_GENERATOR, bars_file, output_file, model)
+            )
+            output_bytes = output_file.stat().st_size if output_file.exists() else 0
+            if size:
+                lookback_bytes += output_bytes
+            else:
+                disk_bytes += output_bytes
+            output_file.unlink(missing_ok=True)
+        elapsed = time.perf_counter() - start
+        print(
+            f"{file_name} {mode:>16}: {disk_bytes / rows:12,.0f} B/row to disk, "
+            f"{lookback_bytes / rows:12,.0f} B/row to {args.lookback_dir}, {rows / elapsed:8.1f} rows/s"
+        )
+    shutil.rmtree(bench_dir)
+
+
 if __name__ == "__main__":
+    if args.bench_io and not LOOKBACK:
+        parser.error("--bench_io compares the full history against --lookback, which must be set")
+    if LOOKBACK:
+        lookback_dir = Path(tempfile.mkdtemp(prefix="gen_forcasts_", dir=args.lookback_dir))
+        atexit.register(shutil.rmtree, lookback_dir, True)
+    if args.bench_io:
+        for intraday_file in sorted(INTRADAY_DIR.glob("*.csv")):
+            if any(intraday_file.name.endswith(f"-{tf}.csv") for tf in TIME_FRAMES):
+                benchmark_temp_io(intraday_file.name, args.bench_io)
+        sys.exit(0)
+    if args.metrics:
+        metrics = StageMetrics(Path(args.metrics))
+
     # Create or clean directories
     create_or_clean_directory(
         INCREMENTAL_TEMP_DATA_DIR, TIME_FRAMES, clean=not CONTINUE_PREV
@@ -160,10 +954,13 @@ if __name__ == "__main__":
         INCREMENTAL_MATS_TEMP_DIR, TIME_FRAMES, clean=not CONTINUE_PREV
     )
 
+    # Bounds the generator batches running at once in incremental mode
+    slots = BoundedSemaphore(MAX_PROCESSES)
     with ProcessPoolExecutor(max_workers=MAX_PROCESSES) as process_executor:
         with ThreadPoolExecutor() as thread_executor:
             futures: List[Future] = []
             p_bars: List[tqdm] = []
+            pipelined_files: List[Tuple[int, str, FileJournal]] = []
             for intraday_file in INTRADAY_DIR.iterdir():
                 if not intraday_file.is_file():
                     continue
@@ -171,25 +968,27 @@ if __name__ == "__main__":
                     intraday_file.name.endswith(f"-{tf}.csv") for tf in TIME_FRAMES
                 ):
                     continue
-                # Ensure temp files exist
-                (INCREMENTAL_TEMP_DATA_DIR / intraday_file.name).touch(exist_ok=True)
-                if not (
-                    CONTINUE_PREV
-                    and (INCREMENTAL_TEMP_DATA_DIR / intraday_file.name).exists()
-                ):
-                    init_temp_file(intraday_file.name, rows=SKIP_ROWS)
-                    temp_rows = SKIP_ROWS
+                index = BarIndex(intraday_file.name)
+                journal = FileJournal(intraday_file.name, MODELS)
+                if CONTINUE_PREV and journal.exists():
+                    journal.resume()
                 else:
-                    temp_rows = sum(
-                        1
-                        for _ in (INCREMENTAL_TEMP_DATA_DIR / intraday_file.name).open(
-                            "r"
-                        )
-                    )
-                source_rows = sum(
-                    1 for _ in (INTRADAY_DIR / intraday_file.name).open("r")
-                )
-                thread_index = len(futures)
+                    # Ensure temp files exist
+                    (INCREMENTAL_TEMP_DATA_DIR / intraday_file.name).touch(exist_ok=True)
+                    if not (
+                        CONTINUE_PREV
+                        and (INCREMENTAL_TEMP_DATA_DIR / intraday_file.name).exists()
+                    ):
+                        temp_rows = min(SKIP_ROWS, index.rows)
+                        source_offset = init_temp_file(intraday_file.name, index, rows=temp_rows)
+                    else:
+                        # Temp file from a run without journals
+                        temp_rows = len(newline_ends(INCREMENTAL_TEMP_DATA_DIR / intraday_file.name))
+                        source_offset = index.offset(temp_rows)
+                    journal.start(temp_rows, source_offset)
+                temp_rows = journal.rows
+                source_rows = index.rows
+                thread_index = len(p_bars)
                 p_bars.append(
                     tqdm(
                         total=source_rows,
@@ -201,13 +1000,33 @@ if __name__ == "__main__":
                         dynamic_ncols=True,
                     )
                 )
-                future = thread_executor.submit(
-                    process_intraday_file,
-                    thread_index,
-                    intraday_file.name,
-                    temp_rows,
-                    MODELS,
-                    process_executor,
-                )
+                if WINDOW and not GENERATOR:
+                    pipelined_files.append((thread_index, intraday_file.name, journal))
+                    continue
+                if GENERATOR:
+                    future = thread_executor.submit(
+                        process_intraday_file_incremental,
+                        thread_index,
+                        intraday_file.name,
+                        journal,
+                        MODELS,
+                        slots,
+                    )
+                else:
+                    future = thread_executor.submit(
+                        process_intraday_file,
+                        thread_index,
+                        intraday_file.name,
+                        journal,
+                        MODELS,
+                        process_executor,
+                    )
                 futures.append(future)
+            if pipelined_files:
+                run_pipelined(pipelined_files, MODELS, process_executor, WINDOW)
             wait(futures, return_when="ALL_COMPLETED")
+            # Surface errors raised in the file threads
+            for future in futures:
+                future.result()
+    if metrics:
+        metrics.summary(MAX_PROCESSES)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Check the scheduling modes of gen_forcasts_incr.py against each other with stub_generator.py.
+
+    stub_check.py [--rows N] [--files N] [--window N] [--kills N] [--keep DIR]
+
+writes synthetic bar files to a scratch directory, runs gen_forcasts_incr.py on them once
+per mode and compares the Incr files of every mode with those of the per-file row barrier
+(the original rerun scheduler). The pipelined and incremental modes are also run killed
+(SIGKILL to the whole process group) at random points --kills times, each run continuing
+the last with -c, to check that the resumed Incr files have every line exactly once.
+Exits with 1 if any of them differ.
+"""
+
+import argparse
+import filecmp
+import os
+import random
+import shlex
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+HERE = Path(__file__).resolve().parent
+GEN_FORCASTS = HERE / "gen_forcasts_incr.py"
+STUB = HERE / "stub_generator.py"
+TIME_FRAME = "5m"
+SKIP_ROWS = 20
+# Seconds a killed run gets before its SIGKILL, past the interpreter and import start up
+KILL_AFTER = (1.0, 3.0)
+
+
+def write_bars(bars_dir: Path, files: int, rows: int) -> None:
+    """Write `files` bar files of `rows` rows each, the same for the same arguments."""
+    rng = random.Random(f"{files} {rows}")
+    bars_dir.mkdir(parents=True)
+    for i in range(files):
+        with (bars_dir / f"S{i}-{TIME_FRAME}.csv").open("w", newline="") as writer:
+            for row in range(rows):
+                writer.write(f"2024-01-01 {row:05},{rng.random():.4f}\n")
+
+
+def run_mode(work_dir: Path, name: str, extra: List[str], kills: int = 0, env: Optional[Dict[str, str]] = None) -> Path:
+    """
+    Run gen_forcasts_incr.py on a fresh copy of the bars, killed `kills` times and
+    continued with -c after each kill; returns its forecasts directory.
+    """
+    bars_dir = work_dir / name / "Bars"
+    forecasts_dir = work_dir / name / "Forecasts"
+    shutil.copytree(work_dir / "Bars", bars_dir)
+    command = [
+        sys.executable,
+        str(GEN_FORCASTS),
+        "-t", TIME_FRAME,
+        "-s", str(SKIP_ROWS),
+        "-m", "2",
+        "--bars_dir", str(bars_dir),
+        "--forecasts_dir", str(forecasts_dir),
+        "--generator_bin", f"{shlex.quote(sys.executable)} {shlex.quote(str(STUB))}",
+        *extra,
+    ]
+    env = dict(os.environ, **(env or {}))
+    rng = random.Random(name)
+    for kill in range(kills):
+        # A new session, so that the kill also takes the pool workers and generators down
+        process = subprocess.Popen(
+            command + (["-c"] if kill else []),
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+        time.sleep(rng.uniform(*KILL_AFTER))
+        if process.poll() is None:
+            os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+    subprocess.run(
+        command + (["-c"] if kills else []), env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    return forecasts_dir
+
+
+def compare(reference_dir: Path, forecasts_dir: Path, name: str) -> bool:
+    """Print whether every Incr file matches the reference; returns True if they all do."""
+    same = True
+    for reference in sorted(reference_dir.glob("*.csv")):
+        forecasts = forecasts_dir / reference.name
+        if not (forecasts.exists() and filecmp.cmp(reference, forecasts, shallow=False)):
+            print(f"{name:<18}: {reference.name} differs")
+            same = False
+    if same:
+        print(f"{name:<18}: {len(list(reference_dir.glob('*.csv')))} Incr files match")
+    return same
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare gen_forcasts_incr.py modes using the stub generator.")
+    parser.add_argument("--rows", type=int, default=120, help="Rows per bar file")
+    parser.add_argument("--files", type=int, default=3, help="Number of bar files")
+    parser.add_argument("--window", type=int, default=4, help="Rows in flight per file in pipelined mode")
+    parser.add_argument("--kills", type=int, default=4, help="Kills of each killed run (0 skips them)")
+    parser.add_argument("--keep", help="Work in this (new) directory and keep it, instead of a temp directory")
+    args = parser.parse_args()
+
+    work_dir = Path(args.keep) if args.keep else Path(tempfile.mkdtemp(prefix="stub_check_"))
+    try:
+        write_bars(work_dir / "Bars", args.files, args.rows)
+        reference_dir = run_mode(work_dir, "barrier", [])
+        modes = {
+            "pipelined": ["-w", str(args.window)],
+            "incremental": ["-g", f"{shlex.quote(sys.executable)} {shlex.quote(str(STUB))} --incremental", "-b", "4"],
+        }
+        results = [compare(reference_dir, run_mode(work_dir, name, extra), name) for name, extra in modes.items()]
+        if args.kills:
+            for name, extra in modes.items():
+                # The incremental stub is slowed down so that its kills land mid run
+                env = {"STUB_GENERATOR_DELAY": "0.01"} if name == "incremental" else {}
+                forecasts_dir = run_mode(work_dir, f"killed_{name}", extra, args.kills, env)
+                results.append(compare(reference_dir, forecasts_dir, f"killed {name}"))
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    sys.exit(0 if all(results) else 1)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+Stand-in for FDISignalGenerator, for running gen_forcasts_incr.py without the real binary.
+
+Rerun mode, like the real binary (gen_forcasts_incr.py --generator_bin "stub_generator.py"):
+    stub_generator.py <bars csv> <output csv> <model> False
+writes one forecast line per bar of the input file to the output file.
+
+Incremental mode (gen_forcasts_incr.py --generator "stub_generator.py --incremental"):
+    stub_generator.py --incremental <model>
+reads bars from stdin and writes the forecast line of every bar to stdout as it arrives.
+
+Both modes produce the same line for the same bar history, so their outputs can be diffed.
+"""
+
+import os
+import sys
+import time
+from typing import Iterable, Iterator
+
+# Simulated compute cost per forecast, in seconds
+DELAY = float(os.environ.get("STUB_GENERATOR_DELAY", "0"))
+
+
+def forecasts(bars: Iterable[str], model: str) -> Iterator[str]:
+    """Forecast line for every bar: bar key, model, bar count and mean of the last field."""
+    total = 0.0
+    for count, bar in enumerate(bars, start=1):
+        fields = bar.rstrip("\n").split(",")
+        try:
+            total += float(fields[-1])
+        except ValueError:
+            pass
+        if DELAY:
+            time.sleep(DELAY)
+        yield f"{fields[0]},{model},{count},{total / count:.6f}\n"
+
+
+if __name__ == "__main__":
+    if sys.argv[1] == "--incremental":
+        for line in forecasts(sys.stdin, sys.argv[2]):
+            sys.stdout.write(line)
+            sys.stdout.flush()
+    else:
+        input_file, output_file, model = sys.argv[1:4]
+        with open(input_file) as reader, open(output_file, "w") as writer:
+            writer.writelines(forecasts(reader, model))
@@ -1,16 +1,189 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
 import os
+import queue
+import re
+import sys
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from itertools import islice
+
+import openpyxl
 import pandas as pd
 
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pa_csv = pq = None
+
+# Rows of an Excel sheet, header included
+EXCEL_MAX_ROWS = 1048576
+# Text columns with at most this many distinct values (and repeating on average) are read as categories
+CATEGORY_MAX_VALUES = 1000
+# Numbers with a leading zero, like the code "007", which schema inference keeps as text
+LEADING_ZERO_PATTERN = re.compile(r"[+-]?0[0-9]")
+INTEGER_PATTERN = re.compile(r"[+-]?[0-9]+")
+BOOL_VALUES = {"True", "False", "TRUE", "FALSE", "true", "false"}
+
+
+class SchemaMismatch(ValueError):
+    pass
+
+
+def is_transactions_file(file):
+    return file.startswith("transactions_2") and file.endswith(".csv")
+
+
 def find_csv_files(root_dir, pattern="transactions_2*.csv"):
     csv_files = []
     for subdir, _, files in os.walk(root_dir):
         for file in files:
             file = file.lower()
-            if file.startswith("transactions_2") and file.endswith(".csv"):
+            if is_transactions_file(file):
+                csv_files.append(os.path.join(subdir, file))
+    return csv_files
+
+
+def scan_directory(path):
+    # Split a directory into file names and (subdirectory name, is symlink), like os.walk does
+    files, subdirs = [], []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    subdirs.append((entry.name, entry.is_symlink()))
+                else:
+                    files.append(entry.name)
+    except OSError:
+        # os.walk skips directories it cannot list
+        pass
+    return files, subdirs
+
+
+def parallel_walk(root_dir, workers=16):
+    # List every directory of the tree concurrently, then yield (dirpath, filenames) in os.walk order
+    listings = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(scan_directory, root_dir): root_dir}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                listings[path] = future.result()
+                for name, is_symlink in listings[path][1]:
+                    # Like os.walk, symlinked directories are listed but not followed
+                    if not is_symlink:
+                        subdir = os.path.join(path, name)
+                        pending[executor.submit(scan_directory, subdir)] = subdir
+    stack = [root_dir]
+    while stack:
+        path = stack.pop()
+        files, subdirs = listings[path]
+        yield path, files
+        stack.extend(reversed([os.path.join(path, name) for name, is_symlink in subdirs if not is_symlink]))
+
+
+def find_csv_files_parallel(root_dir, workers=16):
+    csv_files = []
+    for subdir, files in parallel_walk(root_dir, workers):
+        for file in files:
+            file = file.lower()
+            if is_transactions_file(file):
                 csv_files.append(os.path.join(subdir, file))
     return csv_files
 
 
+def read_transactions(file, dtype=None, schema=None):
+    if schema is None:
+        return pd.read_csv(file, sep="|", dtype=dtype)
+    # Read with the schema's dtypes instead of inferring them, and refuse files that do not fit
+    dtypes = {**schema["dtypes"], **(dtype or {})}
+    try:
+        if pa_csv is None:
+            df = pd.read_csv(file, sep="|", dtype=dtypes)
+        else:
+            df = read_transactions_arrow(file, dtypes)
+    except ValueError as error:
+        raise SchemaMismatch(f"{file}: {error}") from error
+    if list(df.columns) != schema["columns"]:
+        raise SchemaMismatch(f"{file}: columns {list(df.columns)} differ from the schema's {schema['columns']}")
+    return df
+
+
+def read_transactions_arrow(file, dtypes):
+    # pyarrow's multithreaded CSV parser; pandas' engine="pyarrow" would still infer text columns
+    # and turn codes like "007" into numbers
+    arrow_types = {"int64": pa.int64(), "Int64": pa.int64(), "float64": pa.float64(), "bool": pa.bool_(),
+                   "string": pa.string(), "category": pa.dictionary(pa.int32(), pa.string())}
+    table = pa_csv.read_csv(file, parse_options=pa_csv.ParseOptions(delimiter="|"),
+                            convert_options=pa_csv.ConvertOptions(
+                                column_types={column: arrow_types.get(str(dtype), pa.string())
+                                              for column, dtype in dtypes.items()},
+                                strings_can_be_null=True))
+    return table.to_pandas().astype({column: dtype for column, dtype in dtypes.items() if column in table.column_names})
+
+
+def infer_dtype(series):
+    # The schema dtype of a column of sampled text values, missing values as NaN
+    values = series.dropna()
+    if values.empty:
+        # Empty throughout the sample, so most likely optional text
+        return "string"
+    if values.isin(BOOL_VALUES).all() and len(values) == len(series):
+        return "bool"
+    if not values.str.match(LEADING_ZERO_PATTERN).any() and pd.to_numeric(values, errors="coerce").notna().all():
+        if values.str.fullmatch(INTEGER_PATTERN).all():
+            return "int64" if len(values) == len(series) else "Int64"
+        return "float64"
+    distinct = values.nunique()
+    repeating = distinct <= CATEGORY_MAX_VALUES and distinct * 2 <= len(series)
+    return "category" if repeating else "string"
+
+
+def infer_schema(csv_files, sample_size=20):
+    # Infer column dtypes once, from files spread evenly over the whole list. The sample is read as
+    # text and each type chosen explicitly, so that codes with leading zeros never become numbers.
+    step = max(len(csv_files) // sample_size, 1)
+    sample_df = pd.concat([pd.read_csv(file, sep="|", dtype=str) for file in csv_files[::step][:sample_size]],
+                          ignore_index=True)
+    return {"columns": list(sample_df.columns),
+            "dtypes": {column: infer_dtype(sample_df[column]) for column in sample_df.columns}}
+
+
+def load_schema(path, csv_files, sample_size=20, infer=False):
+    # The registered schema, inferred and stored on first use
+    if os.path.exists(path) and not infer:
+        with open(path) as reader:
+            return json.load(reader)
+    schema = infer_schema(csv_files, sample_size)
+    with open(path, "w") as writer:
+        json.dump(schema, writer, indent=1)
+    print(f"Schema inferred from {min(sample_size, len(csv_files))} files and saved to '{path}'")
+    return schema
+
+
+def concat_typed(dataframes):
+    # Concatenate without turning categoricals with different categories into object columns
+    merged_df = pd.concat(dataframes, ignore_index=True)
+    for column in merged_df.columns:
+        if merged_df[column].dtype != "category" and all(
+                isinstance(df[column].dtype, pd.CategoricalDtype) for df in dataframes):
+            # Files where the column is empty have categories of a different dtype
+            merged_df[column] = pd.api.types.union_categoricals(
+                [df[column].cat.set_categories(df[column].cat.categories.astype(str)) for df in dataframes])
+    return merged_df
+
+
 def merge_csv_files(file_list):
     dataframes = []
     for file in file_list:
@@ -20,13 +193,431 @@ def merge_csv_files(file_list):
     return merged_df
 
 
+def merge_csv_files_parallel(file_list, workers=8, dtype=None, processes=False, schema=None, skip_mismatched=False):
+    # Files are parsed concurrently but concatenated in file_list order, as merge_csv_files does
+    dataframes = [df for _, df in iter_csv_files(file_list, workers, dtype, processes, schema, skip_mismatched)]
+    merged_df = concat_typed(dataframes)
+    return merged_df
+
+
+def file_hash(file):
+    sha256 = hashlib.sha256()
+    with open(file, "rb") as reader:
+        for block in iter(lambda: reader.read(1 << 20), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def part_path(store_dir, file):
+    # Each transactions file keeps its rows in its own Parquet part, named after its path
+    return os.path.join(store_dir, "parts", hashlib.sha1(file.encode()).hexdigest() + ".parquet")
+
+
+def load_manifest(store_dir):
+    manifest_path = os.path.join(store_dir, "manifest.json")
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as reader:
+        return json.load(reader)
+
+
+def save_manifest(store_dir, manifest):
+    manifest_path = os.path.join(store_dir, "manifest.json")
+    with open(manifest_path + ".tmp", "w") as writer:
+        json.dump(manifest, writer, indent=1)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def schema_hash(dtype=None, schema=None):
+    # Identifies the column types parts are parsed with; parts parsed with other types are rebuilt
+    settings = json.dumps({"dtype": dtype, "schema": schema}, sort_keys=True)
+    return hashlib.sha1(settings.encode()).hexdigest()
+
+
+def update_store(store_dir, csv_files, workers=8, dtype=None, processes=False, schema=None, skip_mismatched=False):
+    # Bring the store in line with csv_files, parsing only new or changed files.
+    # The manifest records path, size, mtime, content hash, schema hash and row count of every stored file,
+    # in scan order.
+    os.makedirs(os.path.join(store_dir, "parts"), exist_ok=True)
+    old_manifest = load_manifest(store_dir)
+    current_schema = schema_hash(dtype, schema)
+    manifest = {}
+    to_parse = []
+    counts = {"new": 0, "changed": 0, "retyped": 0, "unchanged": 0, "deleted": 0}
+    for file in csv_files:
+        stat = os.stat(file)
+        entry = old_manifest.get(file)
+        # A part parsed with other column types is rebuilt even if its file did not change
+        typed = entry is not None and entry.get("schema_hash") == current_schema
+        if typed and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            manifest[file] = entry
+            counts["unchanged"] += 1
+            continue
+        sha256 = file_hash(file)
+        if typed and entry["sha256"] == sha256:
+            # Touched but not modified
+            manifest[file] = dict(entry, mtime_ns=stat.st_mtime_ns)
+            counts["unchanged"] += 1
+            continue
+        manifest[file] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha256,
+                          "schema_hash": current_schema, "rows": None}
+        to_parse.append(file)
+        if entry is None:
+            counts["new"] += 1
+        else:
+            counts["changed" if entry["sha256"] != sha256 else "retyped"] += 1
+    for file, df in iter_csv_files(to_parse, workers, dtype, processes, schema, skip_mismatched):
+        df.to_parquet(part_path(store_dir, file) + ".tmp", index=False)
+        os.replace(part_path(store_dir, file) + ".tmp", part_path(store_dir, file))
+        manifest[file]["rows"] = len(df)
+    skipped = set()
+    for file in to_parse:
+        if manifest[file]["rows"] is None:
+            # Skipped because it does not match the schema; it is tried again on the next run
+            del manifest[file]
+            skipped.add(file)
+    counts["skipped"] = len(skipped)
+    for file in old_manifest:
+        if file not in manifest:
+            if os.path.exists(part_path(store_dir, file)):
+                os.remove(part_path(store_dir, file))
+            if file not in skipped:
+                counts["deleted"] += 1
+    save_manifest(store_dir, manifest)
+    return counts
+
+
+def export_key(manifest, output, stream):
+    # What an export was made from: the stored files in order, their contents and types, and how it was written
+    key = json.dumps([[file, entry["sha256"], entry["schema_hash"]] for file, entry in manifest.items()]
+                     + [os.path.abspath(output), stream])
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def export_is_current(store_dir, output, stream):
+    # Whether output is still the untouched export of the store as it is now
+    export_path = os.path.join(store_dir, "export.json")
+    if not os.path.exists(export_path) or not os.path.exists(output):
+        return False
+    with open(export_path) as reader:
+        export = json.load(reader)
+    stat = os.stat(output)
+    return (export["key"] == export_key(load_manifest(store_dir), output, stream)
+            and export["size"] == stat.st_size and export["mtime_ns"] == stat.st_mtime_ns)
+
+
+def save_export(store_dir, output, stream):
+    stat = os.stat(output)
+    export = {"key": export_key(load_manifest(store_dir), output, stream), "size": stat.st_size,
+              "mtime_ns": stat.st_mtime_ns}
+    with open(os.path.join(store_dir, "export.json"), "w") as writer:
+        json.dump(export, writer, indent=1)
+
+
+def export_store(store_dir):
+    # The merged transactions, in the scan order of the last update
+    manifest = load_manifest(store_dir)
+    dataframes = [pd.read_parquet(part_path(store_dir, file)) for file in manifest]
+    return concat_typed(dataframes)
+
+
+def iter_store(store_dir):
+    # The stored transactions one file at a time, in the scan order of the last update
+    for file in load_manifest(store_dir):
+        yield file, pd.read_parquet(part_path(store_dir, file))
+
+
+def iter_csv_files(file_list, workers=8, dtype=None, processes=False, schema=None, skip_mismatched=False):
+    # Parse files concurrently and yield (file, DataFrame) in file_list order, with at most
+    # two files per worker parsed ahead of the consumer. A file that does not match the schema
+    # raises SchemaMismatch, unless skip_mismatched, which reports and skips it.
+    executor_class = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    mismatches = 0
+    with executor_class(max_workers=workers) as executor:
+        files = iter(file_list)
+        pending = deque((file, executor.submit(read_transactions, file, dtype, schema))
+                        for file in islice(files, 2 * workers))
+        while pending:
+            file, future = pending.popleft()
+            for next_file in islice(files, 1):
+                pending.append((next_file, executor.submit(read_transactions, next_file, dtype, schema)))
+            try:
+                df = future.result()
+            except SchemaMismatch as error:
+                if not skip_mismatched:
+                    raise
+                print(f"Schema mismatch, skipped {error}", file=sys.stderr)
+                mismatches += 1
+                continue
+            yield file, df
+    if mismatches:
+        print(f"{mismatches} files did not match the schema and were skipped", file=sys.stderr)
+
+
+class StreamWriter:
+    # Writes DataFrames with the columns of the first one to a file as they come
+
+    def __init__(self, path):
+        self.path = path
+        self.columns = None
+        self.rows = 0
+
+    def write(self, file, df):
+        if self.columns is None:
+            self.columns = list(df.columns)
+        elif list(df.columns) != self.columns:
+            raise ValueError(f"{file} has columns {list(df.columns)}, expected {self.columns}")
+        self._write(file, df)
+        self.rows += len(df)
+
+    def close(self):
+        pass
+
+
+class CsvStreamWriter(StreamWriter):
+    def __init__(self, path):
+        super().__init__(path)
+        self.writer = open(path, "w", newline="")
+
+    def _write(self, file, df):
+        df.to_csv(self.writer, index=False, header=self.writer.tell() == 0)
+
+    def close(self):
+        self.writer.close()
+
+
+class ParquetStreamWriter(StreamWriter):
+    # One row group per file, all cast to the schema of the first file
+    def __init__(self, path):
+        super().__init__(path)
+        self.writer = None
+
+    def _write(self, file, df):
+        if self.writer is None:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            self.writer = pq.ParquetWriter(self.path, table.schema)
+        else:
+            try:
+                table = pa.Table.from_pandas(df, schema=self.writer.schema, preserve_index=False)
+            except (pa.ArrowException, TypeError, ValueError) as error:
+                raise ValueError(f"{file} does not match the schema of the first file ({error}); "
+                                 "give the drifting columns an explicit --dtype") from error
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class XlsxStreamWriter(StreamWriter):
+    # Constant-memory write-only workbook that spills into Sheet2, Sheet3, ... past Excel's row limit
+    def __init__(self, path):
+        super().__init__(path)
+        self.workbook = openpyxl.Workbook(write_only=True)
+        self.sheet = None
+        self.sheet_rows = 0
+
+    def _write(self, file, df):
+        # Empty cells for missing values, as to_excel writes them
+        values = df.astype(object).where(df.notna(), None)
+        for row in values.itertuples(index=False, name=None):
+            if self.sheet is None or self.sheet_rows == EXCEL_MAX_ROWS:
+                self.sheet = self.workbook.create_sheet(f"Sheet{len(self.workbook.worksheets) + 1}")
+                self.sheet.append(self.columns)
+                self.sheet_rows = 1
+            self.sheet.append(row)
+            self.sheet_rows += 1
+
+    def close(self):
+        if self.sheet is None:
+            self.workbook.create_sheet("Sheet1").append(self.columns or [])
+        self.workbook.save(self.path)
+
+
+def stream_writer(path):
+    extension = os.path.splitext(path)[1].lower()
+    writers = {".csv": CsvStreamWriter, ".parquet": ParquetStreamWriter, ".xlsx": XlsxStreamWriter}
+    if extension not in writers:
+        raise ValueError(f"Unsupported output format '{extension}', use .xlsx, .csv or .parquet")
+    return writers[extension](path)
+
+
+def write_merged(merged_df, path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".csv":
+        merged_df.to_csv(path, index=False)
+    elif extension == ".parquet":
+        merged_df.to_parquet(path, index=False)
+    else:
+        merged_df.to_excel(path, index=False)
+
+
+def stream_to_file(chunks, path):
+    # Write (file, DataFrame) chunks as they arrive, without holding more than one of them
+    writer = stream_writer(path)
+    try:
+        for file, df in chunks:
+            writer.write(file, df)
+    finally:
+        writer.close()
+    return writer.rows
+
+
+def peak_memory_mb():
+    # Peak resident memory of this process in MB, measured as peak_memory_mb in XNES Reports/XNES_Report.py
+    # does; keep the two the same so that the benchmarks compare
+    if os.path.exists("/proc/self/status"):
+        # On Linux a spawned process' ru_maxrss starts at its parent's peak, while VmHWM is its own
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 2 ** 10
+    try:
+        import resource
+    except ImportError:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / 2 ** 20
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def measure_output(csv_files, path, stream, workers, dtype, schema, skip_mismatched, results):
+    start = time.perf_counter()
+    if stream:
+        stream_to_file(iter_csv_files(csv_files, workers, dtype, schema=schema, skip_mismatched=skip_mismatched),
+                       path)
+    else:
+        write_merged(merge_csv_files_parallel(csv_files, workers, dtype, schema=schema,
+                                              skip_mismatched=skip_mismatched), path)
+    results.put((time.perf_counter() - start, peak_memory_mb()))
+
+
+def benchmark_memory(csv_files, workers, dtype, schema=None, skip_mismatched=False):
+    # Each mode runs in a fresh process so that its peak resident memory is its own
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as output_dir:
+        for extension in (".xlsx", ".csv", ".parquet"):
+            for stream in (False, True):
+                results = context.Queue()
+                path = os.path.join(output_dir, "merged" + extension)
+                process = context.Process(target=measure_output,
+                                          args=(csv_files, path, stream, workers, dtype, schema, skip_mismatched,
+                                                results))
+                process.start()
+                mode = "streamed" if stream else "in memory"
+                # A process that fails, e.g. on a file that does not match the schema, never puts its result
+                while True:
+                    try:
+                        seconds, peak = results.get(timeout=1)
+                        break
+                    except queue.Empty:
+                        if not process.is_alive():
+                            raise SystemExit(f"The {extension[1:]} {mode} benchmark failed "
+                                             f"(exit code {process.exitcode})")
+                process.join()
+                print(f"{extension[1:]:>8} {mode:>9}: peak {peak:9.1f} MB, {seconds:8.2f}s, "
+                      f"{os.path.getsize(path) / 2 ** 20:9.1f} MB written")
+
+
+def parse_dtypes(specs):
+    # "column=dtype" pairs from the command line
+    dtype = {}
+    for spec in specs or []:
+        column, _, column_type = spec.partition("=")
+        dtype[column] = column_type
+    return dtype or None
+
+
 def main():
-    root_dir = r"\\rdfibi\Kasefet"
-    csv_files = find_csv_files(root_dir)
-    if csv_files:
-        merged_df = merge_csv_files(csv_files)
-        merged_df.to_excel("merged_transactions.xlsx", index=False)
-        print("Merged CSV saved as 'merged_transactions.xlsx'")
+    parser = argparse.ArgumentParser(description="Merge the transactions CSV files under a directory tree")
+    parser.add_argument("root_dir", nargs="?", default=r"\\rdfibi\Kasefet")
+    parser.add_argument("-s", "--scan_workers", type=int, default=16,
+                        help="Number of directories listed concurrently")
+    parser.add_argument("-w", "--parse_workers", type=int, default=8,
+                        help="Number of files parsed concurrently")
+    parser.add_argument("-p", "--processes", action="store_true",
+                        help="Parse files in worker processes instead of threads")
+    parser.add_argument("-d", "--dtype", action="append", metavar="COLUMN=DTYPE",
+                        help="Read a column with an explicit dtype, e.g. -d Account=str; may be repeated")
+    parser.add_argument("--schema",
+                        help="Schema registry file; the column dtypes are inferred once and stored there, then "
+                             "every file is read with them and a file that does not match fails the run")
+    parser.add_argument("--skip_mismatched", action="store_true",
+                        help="With --schema, report and skip the files that do not match it instead of failing")
+    parser.add_argument("--infer_schema", action="store_true",
+                        help="Infer the schema again and overwrite the registry file")
+    parser.add_argument("--schema_sample", type=int, default=20,
+                        help="Number of files, spread over the whole list, the schema is inferred from")
+    parser.add_argument("-c", "--store_dir",
+                        help="Keep the parsed rows of every file in this store with a manifest, and only parse "
+                             "new or changed files; the output is exported from the store unless it is still "
+                             "the export of an unchanged store")
+    parser.add_argument("-o", "--output", default="merged_transactions.xlsx",
+                        help="Output file; .xlsx, .csv or .parquet")
+    parser.add_argument("--stream", action="store_true",
+                        help="Write each file's rows as soon as they are parsed instead of building one DataFrame; "
+                             "xlsx output spills into further sheets past Excel's row limit")
+    parser.add_argument("--bench_memory", action="store_true",
+                        help="Only compare the peak memory and time of building one DataFrame against "
+                             "streaming, for every output format, and exit")
+    parser.add_argument("--serial", action="store_true",
+                        help="Scan and parse one directory and one file at a time")
+    parser.add_argument("--verify", action="store_true",
+                        help="Check that the parallel scan and merge match the serial ones "
+                             "(without --dtype or --schema)")
+    args = parser.parse_args()
+    if args.stream and args.verify:
+        parser.error("--verify compares merged DataFrames, which --stream does not build")
+    if args.schema and args.verify:
+        parser.error("--verify compares against the untyped serial merge, which --schema changes the dtypes of")
+    if args.skip_mismatched and not args.schema:
+        parser.error("--skip_mismatched requires --schema")
+
+    if args.serial:
+        csv_files = find_csv_files(args.root_dir)
+    else:
+        csv_files = find_csv_files_parallel(args.root_dir, args.scan_workers)
+    schema = load_schema(args.schema, csv_files, args.schema_sample, args.infer_schema) if args.schema and csv_files else None
+    if csv_files and args.store_dir and not args.bench_memory:
+        counts = update_store(args.store_dir, csv_files, args.parse_workers, parse_dtypes(args.dtype),
+                              args.processes, schema, args.skip_mismatched)
+        print("Store: {new} new, {changed} changed, {retyped} retyped, {unchanged} unchanged, {deleted} deleted, "
+              "{skipped} skipped files".format(**counts))
+        if export_is_current(args.store_dir, args.output, args.stream) and not args.verify:
+            print(f"Store unchanged since '{args.output}' was exported, nothing to write")
+            return
+    if csv_files and args.bench_memory:
+        benchmark_memory(csv_files, args.parse_workers, parse_dtypes(args.dtype), schema, args.skip_mismatched)
+    elif csv_files and args.stream:
+        if args.store_dir:
+            chunks = iter_store(args.store_dir)
+        elif args.serial:
+            chunks = ((file, read_transactions(file)) for file in csv_files)
+        else:
+            chunks = iter_csv_files(csv_files, args.parse_workers, parse_dtypes(args.dtype), args.processes, schema,
+                                    args.skip_mismatched)
+        rows = stream_to_file(chunks, args.output)
+        if args.store_dir:
+            save_export(args.store_dir, args.output, args.stream)
+        print(f"Streamed {rows} merged rows to '{args.output}'")
+    elif csv_files:
+        if args.store_dir:
+            merged_df = export_store(args.store_dir)
+        elif args.serial:
+            merged_df = merge_csv_files(csv_files)
+        else:
+            merged_df = merge_csv_files_parallel(csv_files, args.parse_workers, parse_dtypes(args.dtype),
+                                                 args.processes, schema, args.skip_mismatched)
+        if args.verify and not args.serial:
+            # With a store, its export is checked against a full merge of the files
+            assert csv_files == find_csv_files(args.root_dir), "Parallel scan differs from os.walk"
+            pd.testing.assert_frame_equal(merged_df, merge_csv_files(csv_files))
+            print("Parallel scan and merge match the serial ones")
+        write_merged(merged_df, args.output)
+        if args.store_dir:
+            save_export(args.store_dir, args.output, args.stream)
+        print(f"Merged CSV saved as '{args.output}'")
     else:
         print("No CSV files found with the specified pattern.")
 
@@ -1,12 +1,32 @@
+import argparse
+import hashlib
+import io
+import json
+import multiprocessing
 import os
-import pyodbc
+import queue
+import sys
+import threading
+import time
 import pandas as pd
+import pyarrow as pa
 import openpyxl as pyxl
+from openpyxl.utils import column_index_from_string
 from openpyxl.worksheet.worksheet import Worksheet
-from pyodbc import Connection, Cursor
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
-from typing import Tuple, List, Optional
+from typing import Any, Callable, Dict, Iterator, Tuple, List, Optional
+
+try:
+    import pyodbc
+    from pyodbc import Connection, Cursor
+except ImportError:
+    # Only needed against the real database; the SQLite stand-in in stub_db.py runs without an ODBC driver
+    pyodbc = None
+    Connection = Cursor = Any
 
 # Load environment variables
 load_dotenv()
@@ -25,13 +45,84 @@ MARGIN_STORED_PROC: str = os.getenv("MARGIN_STORED_PROC", "")
 VAR_STORED_PROC: str = os.getenv("VAR_STORED_PROC", "")
 POS_CHANGES_STORED_PROC: str = os.getenv("POS_CHANGES_STORED_PROC", "")
 
+# Rows per fetchmany() call; 0 fetches the whole result with fetchall()
+FETCH_BATCH_SIZE: int = 10000
+
+
+class ResultCache:
+    """
+    On-disk cache of stored procedure results, one Parquet file per procedure and parameters.
+
+    Results whose dates are all before today never change and are kept for good. Results for today or a later
+    date (or without any date) are fetched again once they are older than `ttl` seconds.
+    """
+
+    def __init__(self, cache_dir: str, ttl: float, refresh: bool = False) -> None:
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        # Fetch everything again, replacing the cached results
+        self.refresh = refresh
+        os.makedirs(cache_dir, exist_ok=True)
+        self.stats: Counter = Counter()
+        self.lock = threading.Lock()
+
+    def path(self, stored_proc: str, params: Tuple, column_names: Optional[List[str]]) -> str:
+        key = json.dumps([stored_proc, [str(param) for param in params], column_names], ensure_ascii=False)
+        return os.path.join(self.cache_dir, f"{hashlib.sha256(key.encode()).hexdigest()}.parquet")
+
+    @staticmethod
+    def expires(params: Tuple) -> bool:
+        """Whether a result can still change: its parameters include no date before today."""
+        dates = []
+        for param in params:
+            try:
+                dates.append(datetime.strptime(str(param), "%Y-%m-%d").date())
+            except ValueError:
+                pass
+        return not dates or max(dates) >= RUN_DATE.date()
+
+    def get(self, stored_proc: str, params: Tuple, column_names: Optional[List[str]]) -> Optional[pd.DataFrame]:
+        """The cached result of a call, or None if it has to be fetched."""
+        path = self.path(stored_proc, params, column_names)
+        if self.refresh:
+            outcome = "refreshed"
+        elif not os.path.exists(path):
+            outcome = "missing"
+        elif self.expires(params) and time.time() - os.path.getmtime(path) > self.ttl:
+            outcome = "expired"
+        else:
+            with self.lock:
+                self.stats["hit"] += 1
+            return pd.read_parquet(path)
+        with self.lock:
+            self.stats[outcome] += 1
+        return None
+
+    def put(self, stored_proc: str, params: Tuple, column_names: Optional[List[str]], df: pd.DataFrame) -> None:
+        path = self.path(stored_proc, params, column_names)
+        df.to_parquet(f"{path}.{threading.get_ident()}.tmp", index=False)
+        os.replace(f"{path}.{threading.get_ident()}.tmp", path)
+
+    def summary(self) -> str:
+        misses = self.stats["missing"] + self.stats["expired"] + self.stats["refreshed"]
+        return (f"Cache: {self.stats['hit']} hits, {misses} misses ({self.stats['missing']} not cached, "
+                f"{self.stats['expired']} expired, {self.stats['refreshed']} refreshed)")
+
+
+# Set from the command line; None fetches every result from the database
+RESULT_CACHE: Optional[ResultCache] = None
+
 
 def fetch_data_from_db(conn: Connection, stored_proc: str, params: Tuple,
-                       column_names: Optional[List[str]] = None) -> pd.DataFrame:
+                       column_names: Optional[List[str]] = None, batch_size: int = FETCH_BATCH_SIZE) -> pd.DataFrame:
     """Fetch data from the database using a stored procedure and return it as a DataFrame."""
+    if RESULT_CACHE is not None:
+        cached_df = RESULT_CACHE.get(stored_proc, params, column_names)
+        if cached_df is not None:
+            return cached_df
+
     curr: Cursor = conn.cursor()
     curr.execute(stored_proc, params)
-    rows = curr.fetchall()
 
     # If column_names are provided, use them; otherwise, extract from cursor
     if column_names:
@@ -39,34 +130,323 @@ def fetch_data_from_db(conn: Connection, stored_proc: str, params: Tuple,
     else:
         col_names = [column[0] for column in curr.description]
 
+    if batch_size:
+        df = fetch_batches(curr, col_names, batch_size)
+    else:
+        df = pd.DataFrame.from_records(curr.fetchall(), columns=col_names)
     curr.close()
-    return pd.DataFrame.from_records(rows, columns=col_names)
-
-
-def get_exposures(conn: Connection, equity_id: str, query_date: datetime) -> pd.DataFrame:
+    if RESULT_CACHE is not None:
+        RESULT_CACHE.put(stored_proc, params, column_names, df)
+    return df
+
+
+def fetch_batches(curr: Cursor, col_names: List[str], batch_size: int) -> pd.DataFrame:
+    """
+    Fetch a result `batch_size` rows at a time into Arrow column arrays, so that only one batch of row
+    objects is alive at once and the DataFrame is built from columns rather than from rows.
+
+    Parameters:
+    curr (Cursor): Cursor of an executed stored procedure.
+    col_names (List[str]): Names of the result columns.
+    batch_size (int): Rows per fetchmany() call.
+
+    Returns:
+    pd.DataFrame: The result, with the dtypes DataFrame.from_records gives.
+    """
+    # Arrow arrays, or the values themselves for a batch mixing types Arrow has no common type for
+    chunks: List[List[Any]] = [[] for _ in col_names]
+    while True:
+        rows = curr.fetchmany(batch_size)
+        if not rows:
+            break
+        for column_chunks, values in zip(chunks, zip(*rows)):
+            try:
+                column_chunks.append(pa.array(values, from_pandas=True))
+            except pa.ArrowException:
+                column_chunks.append(list(values))
+        del rows
+    # By position, as a result can repeat a column name
+    columns: Dict[int, pd.Series] = {}
+    for position, column_chunks in enumerate(chunks):
+        column_type = None
+        if all(isinstance(chunk, pa.Array) for chunk in column_chunks):
+            try:
+                column_type = common_type([chunk.type for chunk in column_chunks])
+            except pa.ArrowException:
+                pass
+        if column_type is None:
+            # Values of unrelated types, such as numbers in some batches and text in others, stay objects
+            values = [chunk if isinstance(chunk, list) else chunk.to_pylist() for chunk in column_chunks]
+            columns[position] = pd.Series([value for chunk in values for value in chunk], dtype=object)
+        else:
+            columns[position] = pa.chunked_array([chunk.cast(column_type) for chunk in column_chunks],
+                                                 type=column_type).to_pandas()
+    df = pd.DataFrame(columns, columns=range(len(col_names)))
+    df.columns = col_names
+    return df
+
+
+def common_type(types: List[pa.DataType]) -> pa.DataType:
+    """
+    Arrow type that every batch of a column can be cast to. Each batch's type is inferred from its own
+    values, so the batches of one column can differ: a batch of NULLs has the null type, a batch of whole
+    numbers is int64 where another is double, and Decimal precision and scale follow the values fetched.
+    Decimals are widened to the largest scale and integer digits of any batch.
+
+    Raises:
+    pa.ArrowTypeError: If the types cannot be unified.
+    """
+    if not types:
+        return pa.null()
+    schemas = [pa.schema([("column", column_type)]) for column_type in types]
+    return pa.unify_schemas(schemas, promote_options="permissive").field("column").type
+
+
+class ConnectionPool:
+    """
+    Up to `size` database connections, opened on first use and handed to one thread at a time
+    (pyodbc connections must not be shared between threads).
+    """
+
+    def __init__(self, connect: Callable[[], Connection], size: int):
+        self.connect = connect
+        self.size = size
+        self.idle: queue.Queue = queue.Queue()
+        self.opened: List[Connection] = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def connection(self) -> Iterator[Connection]:
+        """Borrow a connection, opening a new one if none is idle and the pool is not full."""
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                conn = self.connect() if len(self.opened) < self.size else None
+                if conn is not None:
+                    self.opened.append(conn)
+            if conn is None:
+                conn = self.idle.get()
+        try:
+            yield conn
+        finally:
+            self.idle.put(conn)
+
+    def close(self) -> None:
+        for conn in self.opened:
+            conn.close()
+        self.opened = []
+
+
+def get_exposures(conn: Connection, equity_id: str, query_date: datetime,
+                  batch_size: int = FETCH_BATCH_SIZE) -> pd.DataFrame:
     """Fetch exposures data and return as a DataFrame."""
     params: Tuple[str, float, str] = (equity_id, 0.0, query_date.strftime("%Y-%m-%d"))
-    return fetch_data_from_db(conn, EXPOSURES_STORED_PROC, params)
+    return fetch_data_from_db(conn, EXPOSURES_STORED_PROC, params, batch_size=batch_size)
 
 
-def get_margin(conn: Connection, query_date: datetime, equity_id: str) -> pd.DataFrame:
+def get_margin(conn: Connection, query_date: datetime, equity_id: str,
+               batch_size: int = FETCH_BATCH_SIZE) -> pd.DataFrame:
     """Fetch margin data and return as a DataFrame."""
     params: Tuple[str, str] = (query_date.strftime("%Y-%m-%d"), equity_id)
     return fetch_data_from_db(conn, MARGIN_STORED_PROC, params,
-                              column_names=["Date", "VarType", "Margin", "System", "Account", "Sector", "Total M2E"])
+                              column_names=["Date", "VarType", "Margin", "System", "Account", "Sector", "Total M2E"],
+                              batch_size=batch_size)
 
 
-def get_var(conn: Connection, query_date: datetime, equity_id: str) -> pd.DataFrame:
+def get_var(conn: Connection, query_date: datetime, equity_id: str,
+            batch_size: int = FETCH_BATCH_SIZE) -> pd.DataFrame:
     """Fetch VaR data and return as a DataFrame."""
     params: Tuple[str, str] = (query_date.strftime("%Y-%m-%d"), equity_id)
-    return fetch_data_from_db(conn, VAR_STORED_PROC, params, column_names=["Sector", "VaR", "TotalVaR"])
+    return fetch_data_from_db(conn, VAR_STORED_PROC, params, column_names=["Sector", "VaR", "TotalVaR"],
+                              batch_size=batch_size)
 
 
-def get_position_changes(conn: Connection, start_date: datetime, end_date: datetime, equity_id: str) -> pd.DataFrame:
+def get_position_changes(conn: Connection, start_date: datetime, end_date: datetime, equity_id: str,
+                         batch_size: int = FETCH_BATCH_SIZE) -> pd.DataFrame:
     """Fetch position changes data and return as a DataFrame."""
     params: Tuple[str, str, str] = (start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d"), equity_id)
     return fetch_data_from_db(conn, POS_CHANGES_STORED_PROC, params,
-                              column_names=["Code", "Sector", "Name", "qty", "dsc", "date", "PnL"])
+                              column_names=["Code", "Sector", "Name", "qty", "dsc", "date", "PnL"],
+                              batch_size=batch_size)
+
+
+def report_dates(start_date: datetime, end_date: datetime) -> List[datetime]:
+    """Fridays from start_date to end_date, inclusive: the dates weekly reports are made for."""
+    return list(pd.date_range(start_date.date(), end_date.date(), freq="W-FRI").to_pydatetime())
+
+
+def slice_position_changes(pos_changes_df: pd.DataFrame, start_date: datetime, end_date: datetime) -> pd.DataFrame:
+    """Rows of a longer position changes result dated from start_date to end_date, inclusive."""
+    dates = pd.to_datetime(pos_changes_df["date"])
+    # Dates can carry a time of day, so end_date counts up to its midnight at the end
+    first_day = pd.Timestamp(start_date.date())
+    mask = (dates >= first_day) & (dates < pd.Timestamp(end_date.date()) + pd.Timedelta(days=1))
+    return pos_changes_df.loc[mask].reset_index(drop=True)
+
+
+def fetch_report_data(pool: ConnectionPool, equity_ids: List[str], query_dates: List[datetime], workers: int = 4,
+                      batch_size: int = FETCH_BATCH_SIZE) -> Tuple[Dict[Tuple[str, datetime], Dict[str, pd.DataFrame]], Dict[str, List[float]]]:
+    """
+    Run the stored procedures of every report concurrently, each call on a connection of its own from the pool.
+    Exposures, margin and VaR take a single date and run once per account and date; position changes run once
+    per account over the whole range and are split into the weeks of the reports here.
+
+    Parameters:
+    pool (ConnectionPool): Connections to run the procedures on.
+    equity_ids (List[str]): Accounts to report on.
+    query_dates (List[datetime]): Report dates; position changes cover the week up to each of them.
+    workers (int): Procedure calls to run at once.
+    batch_size (int): Rows per fetchmany() call; 0 fetches whole results with fetchall().
+
+    Returns:
+    Tuple[Dict[Tuple[str, datetime], Dict[str, pd.DataFrame]], Dict[str, List[float]]]: The data of every
+    (equity ID, date) report by procedure, and the seconds every call of each procedure took.
+    """
+    first_date, last_date = min(query_dates), max(query_dates)
+    calls = {}
+    for equity_id in equity_ids:
+        for query_date in query_dates:
+            calls["exposures", equity_id, query_date] = (get_exposures, (equity_id, query_date))
+            calls["margin", equity_id, query_date] = (get_margin, (query_date, equity_id))
+            calls["var", equity_id, query_date] = (get_var, (query_date, equity_id))
+        calls["position_changes", equity_id, None] = (get_position_changes,
+                                                      (first_date - timedelta(days=7), last_date, equity_id))
+
+    def timed_fetch(fetch: Callable[..., pd.DataFrame], params: Tuple) -> Tuple[pd.DataFrame, float]:
+        with pool.connection() as conn:
+            start = time.perf_counter()
+            return fetch(conn, *params, batch_size=batch_size), time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {key: executor.submit(timed_fetch, *call) for key, call in calls.items()}
+        results = {key: future.result() for key, future in futures.items()}
+
+    data = {}
+    timings: Dict[str, List[float]] = {}
+    for (name, equity_id, query_date), (df, seconds) in results.items():
+        timings.setdefault(name, []).append(seconds)
+        if query_date is not None:
+            data.setdefault((equity_id, query_date), {})[name] = df
+    for equity_id in equity_ids:
+        pos_changes_df = results["position_changes", equity_id, None][0]
+        for query_date in query_dates:
+            data[equity_id, query_date]["position_changes"] = pos_changes_df if len(query_dates) == 1 else \
+                slice_position_changes(pos_changes_df, query_date - timedelta(days=7), query_date)
+    return data, timings
+
+
+def build_report(template: bytes, query_date: datetime, data: Dict[str, pd.DataFrame]) -> pyxl.Workbook:
+    """Fill a copy of the template, given as the bytes of TEMPLATE.xlsx, with the data of one report."""
+    wb: pyxl.Workbook = pyxl.load_workbook(io.BytesIO(template))
+    ws: Worksheet = wb.active
+    ws.title = "SnapShot"
+
+    # Populate date in the Excel
+    ws['J2'] = query_date.strftime("%Y-%m-%d")
+
+    populate_exposures(ws, data["exposures"])
+    populate_margin(ws, data["margin"])
+    populate_var(ws, data["var"])
+    populate_position_changes(ws, data["position_changes"])
+    return wb
+
+
+def save_report(template: bytes, query_date: datetime, data: Dict[str, pd.DataFrame], report_filename: str) -> str:
+    build_report(template, query_date, data).save(report_filename)
+    return report_filename
+
+
+def peak_memory_mb() -> float:
+    """
+    Peak resident memory of this process, in MB. Measured as peak_memory_mb in MergeTransactions.py
+    does; keep the two the same so that the benchmarks compare.
+    """
+    if os.path.exists("/proc/self/status"):
+        # On Linux a spawned process' ru_maxrss starts at its parent's peak, while VmHWM is its own
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 2 ** 10
+    try:
+        import resource
+    except ImportError:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / 2 ** 20
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def measure_fetch(stub_db: bool, params: Tuple[str, str, str], batch_size: int, results: multiprocessing.Queue) -> None:
+    """Fetch position changes once and report the time and the peak memory it added."""
+    connect = use_stub_db() if stub_db else pyodbc.connect
+    conn = connect(CONN_STRING)
+    columns = ["Code", "Sector", "Name", "qty", "dsc", "date", "PnL"]
+    # A one-day call first, so that the fetch is not charged for connecting and warming up
+    fetch_data_from_db(conn, POS_CHANGES_STORED_PROC, (params[1], params[1], params[2]), columns, batch_size)
+    baseline = peak_memory_mb()
+    start = time.perf_counter()
+    df = fetch_data_from_db(conn, POS_CHANGES_STORED_PROC, params, columns, batch_size)
+    seconds = time.perf_counter() - start
+    results.put((seconds, peak_memory_mb() - baseline, df))
+    conn.close()
+
+
+def benchmark_fetch(stub_db: bool, equity_id: str, end_date: datetime, days: int, batch_size: int) -> None:
+    """Compare fetching `days` of position changes with fetchall() and with fetchmany(), each in a fresh process."""
+    params = ((end_date - timedelta(days=days)).strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d"), equity_id)
+    if stub_db:
+        # Generate the stand-in's data here, so that neither process pays for it
+        conn = use_stub_db()(CONN_STRING)
+        get_position_changes(conn, end_date, end_date, equity_id)
+        conn.close()
+    context = multiprocessing.get_context("spawn")
+    frames = []
+    for name, size in (("fetchall", 0), (f"fetchmany({batch_size})", batch_size)):
+        results = context.Queue()
+        process = context.Process(target=measure_fetch, args=(stub_db, params, size, results))
+        process.start()
+        seconds, peak, df = results.get()
+        process.join()
+        frames.append(df)
+        print(f"{name:>18}: {len(df)} rows in {seconds:6.2f}s, peak memory +{peak:7.1f} MB")
+    print("Results match" if frames[0].equals(frames[1]) else "Results DIFFER")
+
+
+def use_stub_db() -> Callable[[str], Connection]:
+    """Point the stored procedure settings at the SQLite stand-in and return its connect function."""
+    global EXPOSURES_STORED_PROC, MARGIN_STORED_PROC, VAR_STORED_PROC, POS_CHANGES_STORED_PROC
+    import stub_db
+    # Processes started from here share the stand-in's data
+    os.environ["STUB_DB_PATH"] = stub_db.database_path()
+    EXPOSURES_STORED_PROC = stub_db.PROCEDURES["EXPOSURES_STORED_PROC"]
+    MARGIN_STORED_PROC = stub_db.PROCEDURES["MARGIN_STORED_PROC"]
+    VAR_STORED_PROC = stub_db.PROCEDURES["VAR_STORED_PROC"]
+    POS_CHANGES_STORED_PROC = stub_db.PROCEDURES["POS_CHANGES_STORED_PROC"]
+    return stub_db.connect
+
+
+def write_block(ws: Worksheet, df: pd.DataFrame, first_row: int, columns: Dict[str, str]) -> None:
+    """
+    Write DataFrame columns down the sheet, one DataFrame row per sheet row, a block at a time rather than
+    cell by cell.
+
+    Parameters:
+    ws (Worksheet): Sheet to write to.
+    df (pd.DataFrame): Rows to write, in order.
+    first_row (int): Sheet row of the first DataFrame row.
+    columns (Dict[str, str]): Sheet column letter for each DataFrame column to write.
+    """
+    if df.empty:
+        return
+    indexes = [column_index_from_string(letter) for letter in columns]
+    min_col = min(indexes)
+    offsets = [index - min_col for index in indexes]
+    rows = ws.iter_rows(min_row=first_row, max_row=first_row + len(df) - 1, min_col=min_col, max_col=max(indexes))
+    for cells, values in zip(rows, df[list(columns.values())].itertuples(index=False, name=None)):
+        for offset, value in zip(offsets, values):
+            cells[offset].value = value
 
 
 def populate_exposures(ws: Worksheet, exposures_df: pd.DataFrame) -> None:
@@ -80,18 +460,10 @@ def populate_exposures(ws: Worksheet, exposures_df: pd.DataFrame) -> None:
 
     grouped_exposures_df['ofTotal'] = grouped_exposures_df['חשיפה'] / grouped_exposures_df['חשיפה'].sum()
 
-    for i, (index, row) in enumerate(grouped_exposures_df.iterrows()):
-        ws[f'J{i + 9}'] = index
-        ws[f'I{i + 9}'] = row['חשיפה נטו']
-        ws[f'H{i + 9}'] = row['חשיפה']
-        ws[f'G{i + 9}'] = row['ofTotal']
+    write_block(ws, grouped_exposures_df.reset_index(), 9,
+                {'J': 'סקטור', 'I': 'חשיפה נטו', 'H': 'חשיפה', 'G': 'ofTotal'})
 
-    for i, (index, row) in enumerate(exposures_df.iterrows()):
-        if i == 5:
-            break
-        ws[f'D{i + 3}'] = row['שוק']
-        ws[f'C{i + 3}'] = row['חשיפה']
-        ws[f'B{i + 3}'] = row['צד']
+    write_block(ws, exposures_df.head(5), 3, {'D': 'שוק', 'C': 'חשיפה', 'B': 'צד'})
 
 
 def populate_margin(ws: Worksheet, margin_df: pd.DataFrame) -> None:
@@ -99,9 +471,7 @@ def populate_margin(ws: Worksheet, margin_df: pd.DataFrame) -> None:
     margin_df = margin_df.loc[~margin_df['Sector'].isin(['סה"כ', 'ריביות'])]
     margin_df.sort_values(by='Sector', ascending=False, inplace=True, ignore_index=True)
     ws["I14"] = margin_df['Margin'].sum()
-    for i, (index, row) in enumerate(margin_df.iterrows()):
-        ws[f'J{i + 15}'] = row['Sector']
-        ws[f'I{i + 15}'] = row['Margin']
+    write_block(ws, margin_df, 15, {'J': 'Sector', 'I': 'Margin'})
 
 
 def populate_var(ws: Worksheet, var_df: pd.DataFrame) -> None:
@@ -111,52 +481,128 @@ def populate_var(ws: Worksheet, var_df: pd.DataFrame) -> None:
     var_df['VaR'] = var_df['VaR'] * total_var
     var_df.sort_values(by='Sector', ascending=False, inplace=True, ignore_index=True)
     ws["F14"] = var_df['VaR'].sum()
-    for i, (index, row) in enumerate(var_df.iterrows()):
-        ws[f'G{i + 15}'] = row['Sector']
-        ws[f'F{i + 15}'] = row['VaR']
+    write_block(ws, var_df, 15, {'G': 'Sector', 'F': 'VaR'})
 
 
 def populate_position_changes(ws: Worksheet, pos_changes_df: pd.DataFrame) -> None:
     """Populate the position changes section in the Excel sheet."""
-    for i, (index, row) in enumerate(pos_changes_df.iterrows()):
-        ws[f'E{i + 23}'] = row['Code']
-        ws[f'F{i + 23}'] = row['Sector']
-        ws[f'G{i + 23}'] = row['Name']
-        ws[f'H{i + 23}'] = row['qty']
-        ws[f'I{i + 23}'] = row['dsc']
-        ws[f'J{i + 23}'] = row['date']
+    write_block(ws, pos_changes_df, 23,
+                {'E': 'Code', 'F': 'Sector', 'G': 'Name', 'H': 'qty', 'I': 'dsc', 'J': 'date'})
+
+
+def benchmark_populate(rows: int) -> None:
+    """Time filling `rows` synthetic position changes into the template cell by cell and with write_block()."""
+    pos_changes_df = pd.DataFrame({
+        "Code": range(1000, 1000 + rows),
+        "Sector": ["מתכות", "אנרגיה", "חקלאות", "מדדים"] * (rows // 4) + ["מטבעות"] * (rows % 4),
+        "Name": [f"חוזה {i}" for i in range(rows)],
+        "qty": [(i % 101) - 50 for i in range(rows)],
+        "dsc": ["קנייה" if i % 2 else "מכירה" for i in range(rows)],
+        "date": pd.date_range("2024-01-01", periods=rows, freq="min"),
+        "PnL": [i * 1.5 for i in range(rows)],
+    })
+    sheets = {}
+
+    def cell_by_cell(ws: Worksheet, df: pd.DataFrame) -> None:
+        # populate_position_changes as it used to be
+        for i, (index, row) in enumerate(df.iterrows()):
+            ws[f'E{i + 23}'] = row['Code']
+            ws[f'F{i + 23}'] = row['Sector']
+            ws[f'G{i + 23}'] = row['Name']
+            ws[f'H{i + 23}'] = row['qty']
+            ws[f'I{i + 23}'] = row['dsc']
+            ws[f'J{i + 23}'] = row['date']
+
+    for name, populate in (("cell by cell", cell_by_cell), ("write_block", populate_position_changes)):
+        ws = pyxl.load_workbook("TEMPLATE.xlsx").active
+        start = time.perf_counter()
+        populate(ws, pos_changes_df)
+        print(f"{name:>12}: {rows} rows in {time.perf_counter() - start:6.2f}s")
+        sheets[name] = [[cell.value for cell in row] for row in ws.iter_rows(min_row=23, min_col=5, max_col=10)]
+    print("Sheets match" if sheets["cell by cell"] == sheets["write_block"] else "Sheets DIFFER")
 
 
 if __name__ == "__main__":
-    # Connect to the database
-    conn: Connection = pyodbc.connect(CONN_STRING)
-
-    # Load the Excel template
-    wb: pyxl.Workbook = pyxl.load_workbook("TEMPLATE.xlsx")
-    ws: Worksheet = wb.active
-    ws.title = "SnapShot"
-
-    # Populate date in the Excel
-    ws['J2'] = QUERY_DATE.strftime("%Y-%m-%d")
-
-    # Fetch and populate data
-    exposures_df = get_exposures(conn, EQUITY_ID, QUERY_DATE)
-    populate_exposures(ws, exposures_df)
-
-    margin_df = get_margin(conn, QUERY_DATE, EQUITY_ID)
-    populate_margin(ws, margin_df)
-
-    var_df = get_var(conn, QUERY_DATE, EQUITY_ID)
-    populate_var(ws, var_df)
-
-    start_date = QUERY_DATE - timedelta(days=7)
-    pos_changes_df = get_position_changes(conn, start_date, QUERY_DATE, EQUITY_ID)
-    populate_position_changes(ws, pos_changes_df)
-
-    # Close the database connection
-    conn.close()
-
-    # Save the workbook
-    report_filename = f"XNES-COMM-WEEKLY_{QUERY_DATE.strftime('%Y%m%d')}.xlsx"
-    wb.save(report_filename)
-    print(f"Report generated successfully: {report_filename}")
+    parser = argparse.ArgumentParser(description="Generate the weekly XNES snapshot report")
+    parser.add_argument("-w", "--workers", type=int, default=4,
+                        help="Stored procedures to run at once, each on its own database connection")
+    parser.add_argument("--serial", action="store_true",
+                        help="Run the stored procedures one after another on a single connection")
+    parser.add_argument("--start", type=lambda value: datetime.strptime(value, "%Y-%m-%d"),
+                        help="Make a report for every Friday from this date (YYYY-MM-DD) instead of the last one")
+    parser.add_argument("--end", type=lambda value: datetime.strptime(value, "%Y-%m-%d"),
+                        help="Last date of the --start range (default: last Friday)")
+    parser.add_argument("-e", "--equity_ids", nargs="+", default=[EQUITY_ID],
+                        help="Accounts to make reports for (default: EQUITY_ID)")
+    parser.add_argument("-p", "--processes", type=int, default=os.cpu_count(),
+                        help="Processes filling and saving reports, when there are several")
+    parser.add_argument("-c", "--cache_dir",
+                        help="Keep stored procedure results in this directory and reuse them on later runs")
+    parser.add_argument("--cache_ttl", type=float, default=900,
+                        help="Seconds a cached result for today's date stays valid; earlier dates never expire")
+    parser.add_argument("--refresh", action="store_true",
+                        help="Fetch every result from the database again, replacing the cached ones")
+    parser.add_argument("-b", "--batch_size", type=int, default=FETCH_BATCH_SIZE,
+                        help="Rows per fetchmany() call; 0 fetches whole results with fetchall()")
+    parser.add_argument("--bench_fetch", type=int, metavar="DAYS",
+                        help="Compare fetchall() and fetchmany() on DAYS of position changes and exit")
+    parser.add_argument("--bench_populate", type=int, metavar="ROWS",
+                        help="Compare filling ROWS position changes into the template cell by cell and in "
+                             "blocks, and exit")
+    parser.add_argument("--stub_db", action="store_true",
+                        help="Use the SQLite stand-in in stub_db.py instead of the database in CONN_STRING")
+    args = parser.parse_args()
+    if args.bench_populate:
+        benchmark_populate(args.bench_populate)
+        raise SystemExit
+    if args.refresh and not args.cache_dir:
+        parser.error("--refresh needs a --cache_dir")
+    if pyodbc is None and not args.stub_db:
+        parser.error("pyodbc (and an ODBC driver manager) is needed to connect to the database")
+
+    connect = use_stub_db() if args.stub_db else pyodbc.connect
+    if args.bench_fetch:
+        benchmark_fetch(args.stub_db, EQUITY_ID, QUERY_DATE, args.bench_fetch, args.batch_size or FETCH_BATCH_SIZE)
+        raise SystemExit
+
+    if args.cache_dir:
+        RESULT_CACHE = ResultCache(args.cache_dir, args.cache_ttl, args.refresh)
+
+    if args.start:
+        query_dates = report_dates(args.start, args.end or QUERY_DATE)
+        if not query_dates:
+            parser.error("There is no Friday between --start and --end")
+    else:
+        query_dates = [QUERY_DATE]
+
+    # Read the Excel template once; every report is filled in a copy of it
+    with open("TEMPLATE.xlsx", "rb") as template_file:
+        template = template_file.read()
+
+    # Fetch all the data, then populate it
+    fetch_start = time.perf_counter()
+    pool = ConnectionPool(lambda: connect(CONN_STRING), 1 if args.serial else args.workers)
+    data, timings = fetch_report_data(pool, args.equity_ids, query_dates, 1 if args.serial else args.workers,
+                                      args.batch_size)
+    pool.close()
+    fetch_seconds = time.perf_counter() - fetch_start
+    for name, seconds in timings.items():
+        print(f"{name:>16}: {sum(seconds):7.2f}s in {len(seconds)} calls")
+    print(f"{'fetch stage':>16}: {fetch_seconds:7.2f}s "
+          f"({sum(map(sum, timings.values())):.2f}s of procedure time)")
+    if RESULT_CACHE is not None:
+        print(RESULT_CACHE.summary())
+
+    reports = {}
+    for (equity_id, query_date), report_data in data.items():
+        account = f"{equity_id}_" if len(args.equity_ids) > 1 else ""
+        reports[f"XNES-COMM-WEEKLY_{account}{query_date.strftime('%Y%m%d')}.xlsx"] = (query_date, report_data)
+    if len(reports) > 1 and args.processes > 1:
+        with ProcessPoolExecutor(max_workers=args.processes) as executor:
+            futures = [executor.submit(save_report, template, query_date, report_data, report_filename)
+                       for report_filename, (query_date, report_data) in reports.items()]
+            for future in futures:
+                print(f"Report generated successfully: {future.result()}")
+    else:
+        for report_filename, (query_date, report_data) in reports.items():
+            print(f"Report generated successfully: {save_report(template, query_date, report_data, report_filename)}")
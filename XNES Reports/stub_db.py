@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+SQLite stand-in for the XNES database, for running XNES_Report.py without SQL Server or an ODBC driver.
+
+    XNES_Report.py --stub_db
+
+connects through connect() below instead of pyodbc.connect() and calls the stored procedures by the names
+in PROCEDURES. Each call sleeps for STUB_DB_LATENCY seconds, like a round-trip to a busy server, and then
+runs an equivalent query over synthetic positions, margins, VaR and trades. The data of every equity ID is
+generated on first use from a seed derived from the ID, so every run and every process sees the same rows.
+Processes started with STUB_DB_PATH set share that SQLite file instead of generating their own.
+"""
+
+import atexit
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+from typing import Optional, Sequence
+
+# Simulated server latency per stored procedure call, in seconds
+LATENCY = float(os.environ.get("STUB_DB_LATENCY", "0.5"))
+# Trades per calendar day in the position changes data, timestamped like a datetime column from 09:30
+TRADES_PER_DAY = int(os.environ.get("STUB_DB_TRADES_PER_DAY", "5"))
+# Days the trades span
+FIRST_TRADE_DATE = date(2024, 1, 1)
+LAST_TRADE_DATE = date(2027, 12, 31)
+
+# Stored procedure names the stand-in answers to, by the XNES_Report setting they replace
+PROCEDURES = {
+    "EXPOSURES_STORED_PROC": "stub_exposures",
+    "MARGIN_STORED_PROC": "stub_margin",
+    "VAR_STORED_PROC": "stub_var",
+    "POS_CHANGES_STORED_PROC": "stub_position_changes",
+}
+
+MARKETS = {
+    "אנרגיה": ["נפט גולמי", "גז טבעי", "ברנט"],
+    "מתכות": ["זהב", "כסף", "נחושת"],
+    "חקלאות": ["חיטה", "תירס", "סויה", "קפה"],
+    "מדדים": ["S&P 500", "נאסד\"ק 100", "ת\"א 35"],
+    "מטבעות": ["יורו", "ין", "לירה שטרלינג"],
+    "ריביות": ["אג\"ח 10 שנים", "אג\"ח 2 שנים"],
+}
+
+# Queries with the parameters of the real procedures, in order, and the position of the equity ID among them
+QUERIES = {
+    "stub_exposures": ("""
+        SELECT sector AS "סקטור", market AS "שוק", side AS "צד",
+               exposure * (1 + (CAST(julianday(?3) AS INTEGER) % 10) / 100.0) AS "חשיפה",
+               net_exposure * (1 + (CAST(julianday(?3) AS INTEGER) % 10) / 100.0) AS "חשיפה נטו"
+        FROM positions WHERE equity_id = ?1 AND exposure >= ?2 ORDER BY exposure DESC""", 0),
+    "stub_margin": ("""
+        SELECT ?1, 'SPAN', margin * (1 + (CAST(julianday(?1) AS INTEGER) % 7) / 100.0), 'TASE', ?2, sector,
+               total_m2e
+        FROM margins WHERE equity_id = ?2 ORDER BY sector""", 1),
+    "stub_var": ("""
+        SELECT sector, var_share, total_var * (1 + (CAST(julianday(?1) AS INTEGER) % 5) / 100.0)
+        FROM vars WHERE equity_id = ?2 ORDER BY sector""", 1),
+    "stub_position_changes": ("""
+        SELECT code, sector, name, qty, dsc, trade_date, pnl
+        FROM trades WHERE trade_date >= ?1 AND trade_date < date(?2, '+1 day') AND equity_id = ?3
+        ORDER BY trade_date, code""", 2),
+}
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS accounts (equity_id TEXT PRIMARY KEY);
+    CREATE TABLE IF NOT EXISTS positions (equity_id TEXT, sector TEXT, market TEXT, side TEXT, exposure REAL,
+                                          net_exposure REAL);
+    CREATE TABLE IF NOT EXISTS margins (equity_id TEXT, sector TEXT, margin REAL, total_m2e REAL);
+    CREATE TABLE IF NOT EXISTS vars (equity_id TEXT, sector TEXT, var_share REAL, total_var REAL);
+    CREATE TABLE IF NOT EXISTS trades (equity_id TEXT, code INTEGER, sector TEXT, name TEXT, qty INTEGER,
+                                       dsc TEXT, trade_date TEXT, pnl REAL);
+    CREATE INDEX IF NOT EXISTS trades_by_date ON trades (equity_id, trade_date);
+"""
+
+_database_path: Optional[str] = os.environ.get("STUB_DB_PATH")
+_lock = threading.Lock()
+
+
+def database_path() -> str:
+    """Path of the SQLite file, created on first use and removed at exit unless it came from STUB_DB_PATH."""
+    global _database_path
+    with _lock:
+        if _database_path is None:
+            fd, _database_path = tempfile.mkstemp(prefix="xnes_stub_", suffix=".sqlite")
+            os.close(fd)
+            atexit.register(remove_database, _database_path)
+            with sqlite3.connect(_database_path) as db:
+                db.execute("PRAGMA journal_mode=WAL")
+                db.executescript(SCHEMA)
+    return _database_path
+
+
+def remove_database(path: str) -> None:
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def add_account(db: sqlite3.Connection, equity_id: str) -> None:
+    """Generate the positions, margins, VaR and trades of an equity ID, unless it already has them."""
+    with _lock:
+        if db.execute("SELECT 1 FROM accounts WHERE equity_id = ?", (equity_id,)).fetchone():
+            return
+        rng = random.Random(equity_id)
+        markets = [(sector, market) for sector, names in MARKETS.items() for market in names]
+        positions = []
+        for sector, market in markets:
+            exposure = round(rng.uniform(1e5, 5e6), 2)
+            side = rng.choice(["קנייה", "מכירה"])
+            positions.append((equity_id, sector, market, side, exposure, exposure if side == "קנייה" else -exposure))
+        margins = [(equity_id, sector, round(rng.uniform(5e4, 8e5), 2), 0.0) for sector in MARKETS]
+        margins.append((equity_id, 'סה"כ', sum(row[2] for row in margins), sum(row[2] for row in margins)))
+        shares = [rng.random() for _ in MARKETS]
+        vars_ = [(equity_id, sector, share / sum(shares), 0.0) for sector, share in zip(MARKETS, shares)]
+        vars_.append((equity_id, 'סה"כ', 1.0, round(rng.uniform(1e6, 5e6), 2)))
+        trades = []
+        day = FIRST_TRADE_DATE
+        while day <= LAST_TRADE_DATE:
+            for trade in range(TRADES_PER_DAY):
+                code = rng.randrange(len(markets))
+                sector, market = markets[code]
+                qty = rng.randint(-50, 50) or 1
+                trades.append((equity_id, 1000 + code, sector, market, qty, "קנייה" if qty > 0 else "מכירה",
+                               f"{day.isoformat()} {9 + (30 + 45 * trade) // 60:02}:{(30 + 45 * trade) % 60:02}:00",
+                               round(rng.gauss(0, 2e4), 2)))
+            day += timedelta(days=1)
+        db.executemany("INSERT INTO positions VALUES (?, ?, ?, ?, ?, ?)", positions)
+        db.executemany("INSERT INTO margins VALUES (?, ?, ?, ?)", margins)
+        db.executemany("INSERT INTO vars VALUES (?, ?, ?, ?)", vars_)
+        db.executemany("INSERT INTO trades VALUES (?, ?, ?, ?, ?, ?, ?, ?)", trades)
+        db.execute("INSERT INTO accounts VALUES (?)", (equity_id,))
+        db.commit()
+
+
+class StubCursor:
+    """pyodbc.Cursor look-alike: execute() takes a procedure name and its parameters."""
+
+    def __init__(self, db: sqlite3.Connection):
+        self.db = db
+        self.cursor = db.cursor()
+
+    def execute(self, stored_proc: str, params: Sequence = ()) -> "StubCursor":
+        query, equity_index = QUERIES[stored_proc]
+        time.sleep(LATENCY)
+        add_account(self.db, params[equity_index])
+        self.cursor.execute(query, params)
+        return self
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchmany(self, size: int = 1):
+        return self.cursor.fetchmany(size)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def close(self) -> None:
+        self.cursor.close()
+
+
+class StubConnection:
+    """pyodbc.Connection look-alike over this process' SQLite file."""
+
+    def __init__(self):
+        self.db = sqlite3.connect(database_path(), check_same_thread=False, timeout=60)
+
+    def cursor(self) -> StubCursor:
+        return StubCursor(self.db)
+
+    def close(self) -> None:
+        self.db.close()
+
+
+def connect(conn_string: str = "") -> StubConnection:
+    """Stand-in for pyodbc.connect(); the connection string is ignored."""
+    return StubConnection()
@@ -1,9 +1,17 @@
 from collections import defaultdict
+import argparse
+import io
 import math
 from datetime import datetime
 import glob
 import os
-from typing import Dict, Optional, Tuple
+import pickle
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Dict, Iterator, List, Optional, Tuple
+import numpy as np
 import pandas as pd
 import sys
 
@@ -11,35 +19,163 @@ pd.set_option("display.max_rows", 500)
 pd.set_option("display.max_columns", 500)
 pd.set_option("display.width", 1000)
 
+POSITION_COLUMNS = ["Market", "Open", "Close", "Duration", "OverNight"]
+STATS_COLUMNS = [
+    "Engine",
+    "Trading Days",
+    "Positions",
+    "Over Night Positions",
+    "Average Position Duration(Minutes)",
+    "Trades",
+    "Volume",
+]
 
-output = []
-vol_output = []
 
-os.chdir(sys.argv[1])
-for file in glob.glob("*.{}".format("csv")):
-    df = pd.read_csv(rf"{file}")
-    engine = file.split(".")[0]
-    if engine == "stats" or engine == "volumes":
-        continue
-    # current_positions_mkt: Dict[str, Dict[str, Tuple[int, datetime]]] = defaultdict(
-    #     lambda: defaultdict(lambda: (0, datetime.now()))
-    # )
-    current_positions_mkt: Dict[str, Tuple[int, datetime]] = defaultdict(
-        lambda: (0, datetime.now())
+# Fixed UTCTime layout: YYYY-mm-dd HH:MM:SS.ffffff
+UTC_TIME_LENGTH = 26
+UTC_TIME_SEPARATORS = {4: "-", 7: "-", 10: " ", 13: ":", 16: ":", 19: "."}
+UTC_TIME_DIGITS = [i for i in range(UTC_TIME_LENGTH) if i not in UTC_TIME_SEPARATORS]
+NS_PER_DAY = 86_400 * 10**9
+# Parsed fills take roughly this many times their csv size in memory
+IN_MEMORY_ROW_FACTOR = 10
+# Rough memory per ClOrdID held in a Python set, and the share of a streaming budget they may use
+CLORDID_BYTES = 100
+CLORDID_MEMORY_SHARE = 0.25
+# Files the ClOrdIDs of a streaming run spill into once they outgrow their share
+CLORDID_PARTITIONS = 64
+# Columns kept by the fill cache
+FILL_COLUMNS = ["UTCTime", "Instrument", "Amount", "ClOrdID"]
+
+
+def parse_utc_times(utc_time: pd.Series) -> np.ndarray:
+    """
+    Single pass parser for UTCTime strings in the fixed YYYY-mm-dd HH:MM:SS.ffffff layout.
+
+    The strings are viewed as a (rows x bytes) uint8 matrix and every field is decoded
+    with integer arithmetic, giving int64 nanoseconds since the epoch.
+    Raises ValueError naming the first malformed rows.
+    """
+    values = utc_time.to_numpy(dtype=object)
+    try:
+        # One spare byte so that over-long strings are caught instead of truncated
+        raw = np.asarray(values, dtype=f"S{UTC_TIME_LENGTH + 1}")
+    except (UnicodeEncodeError, TypeError):
+        raw = np.asarray(
+            [str(value).encode("ascii", "replace") for value in values],
+            dtype=f"S{UTC_TIME_LENGTH + 1}",
+        )
+    chars = raw.view(np.uint8).reshape(len(raw), UTC_TIME_LENGTH + 1)
+    digits = chars[:, UTC_TIME_DIGITS].astype(np.int64) - ord("0")
+
+    bad = (chars[:, UTC_TIME_LENGTH] != 0) | ((digits < 0) | (digits > 9)).any(axis=1)
+    for position, separator in UTC_TIME_SEPARATORS.items():
+        bad |= chars[:, position] != ord(separator)
+
+    def field(start: int, width: int) -> np.ndarray:
+        number = np.zeros(len(digits), dtype=np.int64)
+        for column in range(start, start + width):
+            number = number * 10 + digits[:, column]
+        return number
+
+    # Columns of `digits`: YYYY MM DD HH MM SS ffffff
+    year, month, day = field(0, 4), field(4, 2), field(6, 2)
+    hour, minute, second, micro = field(8, 2), field(10, 2), field(12, 2), field(14, 6)
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    month_days = np.array([0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])[np.clip(month, 0, 12)]
+    bad |= (month < 1) | (month > 12) | (day < 1) | (day > month_days + (leap & (month == 2)))
+    bad |= (hour > 23) | (minute > 59) | (second > 59)
+    if bad.any():
+        rows = np.flatnonzero(bad)
+        examples = ", ".join(f"row {row}: {values[row]!r}" for row in rows[:5])
+        raise ValueError(
+            f"{len(rows)} malformed UTCTime value(s), expected YYYY-mm-dd HH:MM:SS.ffffff ({examples})"
+        )
+
+    # Days since 1970-01-01 of the proleptic Gregorian date (days_from_civil)
+    y = year - (month <= 2)
+    era = y // 400
+    yoe = y - era * 400
+    doy = (153 * (month + np.where(month > 2, -3, 9)) + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    days = era * 146097 + doe - 719468
+    return (
+        days * NS_PER_DAY
+        + ((hour * 60 + minute) * 60 + second) * 10**9
+        + micro * 1000
     )
-    positions = []
-    overnight_positions = 0
-    save = 0
-    trades = df["ClOrdID"].nunique()
-    vol: Dict[str, int] = defaultdict(int)
+
+
+def parse_times_strptime(df: pd.DataFrame) -> pd.DataFrame:
+    """Original two pass UTCTime parsing (split for the Date, then strptime), kept for benchmarking."""
     a = df["UTCTime"].str.split(
         " ",
         expand=True,
     )
     df["Date"] = pd.to_datetime(a[0], format="%Y-%m-%d")
     df["UTCTime"] = pd.to_datetime(df["UTCTime"], format="%Y-%m-%d %H:%M:%S.%f")
-    df.sort_values(by="UTCTime", inplace=True)
+    return df
+
+
+def parse_times(df: pd.DataFrame) -> pd.DataFrame:
+    """Parse UTCTime in a single pass and derive the trading Date by truncating it to the day."""
+    if pd.api.types.is_datetime64_dtype(df["UTCTime"]):
+        # Already typed, e.g. loaded from the fill cache
+        utc_ns = df["UTCTime"].to_numpy(dtype="datetime64[ns]").view(np.int64)
+    else:
+        utc_ns = parse_utc_times(df["UTCTime"])
+    df["Date"] = (utc_ns - utc_ns % NS_PER_DAY).view("datetime64[ns]")
+    df["UTCTime"] = utc_ns.view("datetime64[ns]")
+    return df
+
+
+def parse_fills(df: pd.DataFrame) -> pd.DataFrame:
+    """Parse the UTCTime column, add the trading Date and sort the fills by time."""
+    df = parse_times(df)
+    # Stable, so fills sharing a timestamp keep their file order (and an appended tail
+    # sorts the same way on its own as it does as part of the whole file)
+    df.sort_values(by="UTCTime", inplace=True, kind="stable")
     # df = df.loc[(df["Date"] >= "2022-01-01") & (df["Date"] <= "2025-01-01")]
+    return df
+
+
+def benchmark_time_parsing(files: List[str], repeat: int = 3) -> None:
+    """Compare the single pass UTCTime parser with the original split + strptime path."""
+    for file in files:
+        utc_time = pd.read_csv(rf"{file}", usecols=["UTCTime"])
+        timings = {}
+        for name, parser in (("strptime", parse_times_strptime), ("single pass", parse_times)):
+            best = math.inf
+            for _ in range(repeat):
+                df = utc_time.copy()
+                start = time.perf_counter()
+                df = parser(df)
+                best = min(best, time.perf_counter() - start)
+            timings[name] = best
+        print(
+            f"{file}: {len(utc_time)} rows, strptime {timings['strptime']:.3f}s, "
+            f"single pass {timings['single pass']:.3f}s "
+            f"({timings['strptime'] / timings['single pass']:.1f}x)"
+        )
+
+
+def reconstruct_positions_loop(
+    df: pd.DataFrame, now: Optional[datetime] = None
+) -> Tuple[pd.DataFrame, Dict[str, int]]:
+    """
+    Reference engine: walk the fills one by one and track the position per market.
+
+    now is the open time of a market that closes before it was ever opened (a zero-amount
+    first fill); it defaults to the current time.
+    """
+    now = now or datetime.now()
+    # current_positions_mkt: Dict[str, Dict[str, Tuple[int, datetime]]] = defaultdict(
+    #     lambda: defaultdict(lambda: (0, datetime.now()))
+    # )
+    current_positions_mkt: Dict[str, Tuple[int, datetime]] = defaultdict(
+        lambda: (0, now)
+    )
+    positions = []
+    vol: Dict[str, int] = defaultdict(int)
     for index, row in df.iterrows():
         mkt = row["Instrument"].split(".")[-1][:-1]
         # sub_strat =
@@ -77,11 +213,108 @@ for file in glob.glob("*.{}".format("csv")):
                 current_position[1],
             )
 
+    positions_df = pd.DataFrame(positions, columns=POSITION_COLUMNS)
+    return positions_df, dict(vol)
+
+
+def market_codes(instruments: pd.Series) -> Tuple[np.ndarray, List[str]]:
+    """Map every fill to a market index, splitting each distinct Instrument only once."""
+    codes, uniques = pd.factorize(instruments)
+    names = np.array([instrument.split(".")[-1][:-1] for instrument in uniques], dtype=object)
+    # Several instruments (e.g. contract months) share a market, numbered by first appearance
+    mkt_codes, markets = pd.factorize(names[codes])
+    return mkt_codes, list(markets)
+
+
+def reconstruct_positions(
+    df: pd.DataFrame,
+    open_positions: Optional[Dict[str, Tuple[int, pd.Timestamp]]] = None,
+    now: Optional[datetime] = None,
+) -> Tuple[pd.DataFrame, Dict[str, int]]:
+    """
+    Columnar engine: find the position open/close/flip events of every market in bulk.
+
+    Per market the position after each fill is the running sum of Amount. A fill opens
+    a position when the market is flat before it, and closes one (or flips it) when the
+    position before and after the fill do not share a sign. Every open and close resets
+    the position's open time, so a close is matched with the latest such event before it.
+
+    open_positions, when given, holds the (position, open time) per market carried over
+    from earlier fills; it is used as the starting state and updated in place. now is
+    the open time of a market that closes before it was ever opened, as in the loop engine.
+    """
+    codes, markets = market_codes(df["Instrument"])
+    amount = df["Amount"].to_numpy()
+    times = pd.Series(df["UTCTime"].to_numpy(), index=df.index)
+    by_mkt = pd.Series(amount, index=df.index).groupby(codes, sort=False)
+    if open_positions is None:
+        open_positions = {}
+    carried = [open_positions.get(mkt, (0, pd.NaT)) for mkt in markets]
+    carried_pos = np.array([position for position, _ in carried], dtype=amount.dtype)
+    carried_open = pd.Series([open_time for _, open_time in carried], dtype=times.dtype)
+
+    pos_after = by_mkt.cumsum().to_numpy() + carried_pos[codes]
+    pos_before = pos_after - amount
+    opens = (pos_before == 0) & (amount != 0)
+    closes = ~opens & (pos_before * pos_after <= 0)
+
+    # Open time in effect before each fill: the time of the last open/close in the market
+    resets = times.where(opens | closes)
+    open_times = resets.groupby(codes, sort=False).shift(1)
+    open_times = open_times.groupby(codes, sort=False).ffill()
+    open_times = open_times.fillna(pd.Series(carried_open.to_numpy()[codes], index=df.index))
+    # A zero-amount fill on a market that was never opened closes "since now", as the loop does
+    open_times = open_times.fillna(pd.Timestamp(now or datetime.now()))
+
+    entry = open_times[closes]
+    exit = times[closes]
     positions_df = pd.DataFrame(
-        positions, columns=["Market", "Open", "Close", "Duration", "OverNight"]
+        {
+            "Market": np.array(markets, dtype=object)[codes[closes]],
+            "Open": entry.to_numpy(),
+            "Close": exit.to_numpy(),
+            "Duration": ((exit - entry).dt.total_seconds() / 60).to_numpy(),
+            "OverNight": (exit > entry.dt.normalize() + pd.Timedelta(hours=22)).to_numpy(),
+        },
+        columns=POSITION_COLUMNS,
     )
+
+    # State after the last fill of every market, for the next batch of fills
+    last = pd.Series(np.arange(len(codes))).groupby(codes, sort=True).max().to_numpy()
+    last_reset = resets.groupby(codes, sort=False).ffill().to_numpy()[last]
+    last_open = np.where(pd.isna(last_reset), open_times.to_numpy()[last], last_reset)
+    for i, mkt in enumerate(markets):
+        open_positions[mkt] = (pos_after[last[i]], pd.Timestamp(last_open[i]))
+
+    volumes = np.zeros(len(markets), dtype=amount.dtype)
+    np.add.at(volumes, codes, np.abs(amount))
+    vol = dict(zip(markets, volumes))
+    return positions_df, vol
+
+
+def duration_total(positions_df: pd.DataFrame) -> Tuple[int, int]:
+    """
+    Exact sum, in nanoseconds, and count of the non-missing position durations. Integer sums
+    do not depend on how the positions are split into batches, unlike float sums.
+    """
+    spans = pd.to_timedelta(positions_df["Close"] - positions_df["Open"]).to_numpy("timedelta64[ns]")
+    spans = spans[~np.isnat(spans)].view("int64")
+    # Summed in 32-bit halves so that neither int64 sum can overflow
+    total = (int((spans >> 32).sum()) << 32) + int((spans & 0xFFFFFFFF).sum())
+    return total, len(spans)
+
+
+def mean_duration(total: int, count: int) -> float:
+    """Average position duration in minutes from duration_total, rounded once (NaN without positions)."""
+    return total / (count * 60 * 10**9) if count else np.nan
+
+
+def engine_stats(
+    engine: str, df: pd.DataFrame, positions_df: pd.DataFrame, vol: Dict[str, int], trades: int
+) -> list:
+    """Build the stats.csv row of a single engine."""
     overnight_positions = positions_df["OverNight"].sum()
-    average_duration = positions_df["Duration"].mean()
+    average_duration = mean_duration(*duration_total(positions_df))
     # print(f"Engine: {engine}")
     # print(f"Trading Days: {a[0].nunique()}")
     # print(f"Positions: {closed_positions}")
@@ -89,32 +322,509 @@ for file in glob.glob("*.{}".format("csv")):
     # print(f"Average Position Duration: {average_duration} Minutes")
     # print(f"Trades: {trades}")
     # print(f"Volume: {vol}")
-    output.append(
-        [
-            engine,
-            df["Date"].nunique(),
-            len(positions_df),
-            overnight_positions,
-            average_duration,
-            trades,
-            sum(vol.values()),
-        ]
+    return [
+        engine,
+        df["Date"].nunique(),
+        len(positions_df),
+        overnight_positions,
+        average_duration,
+        trades,
+        sum(vol.values()),
+    ]
+
+
+def load_fills_cached(file: str, cache_dir: str) -> pd.DataFrame:
+    """
+    Load an engine's fills through an Arrow IPC sidecar cache.
+
+    The cache keeps only the columns the stats need, with UTCTime already parsed and
+    Instrument dictionary encoded, and is memory mapped on read. It is rebuilt whenever
+    the source csv size or mtime changes.
+    """
+    import pyarrow as pa
+
+    engine = file.split(".")[0]
+    cache_path = os.path.join(cache_dir, f"{engine}.arrow")
+    source = os.stat(file)
+    key = {b"size": str(source.st_size).encode(), b"mtime_ns": str(source.st_mtime_ns).encode()}
+
+    if os.path.exists(cache_path):
+        start = time.perf_counter()
+        with pa.memory_map(cache_path, "r") as source_map:
+            table = pa.ipc.open_file(source_map).read_all()
+            metadata = table.schema.metadata or {}
+            if all(metadata.get(name) == value for name, value in key.items()):
+                df = table.to_pandas()
+                load_time = time.perf_counter() - start
+                csv_time = float(metadata[b"csv_seconds"])
+                print(
+                    f"{engine}: loaded from cache in {load_time:.3f}s "
+                    f"(csv {csv_time:.3f}s, {csv_time / max(load_time, 1e-9):.1f}x)"
+                )
+                return df
+
+    start = time.perf_counter()
+    df = pd.read_csv(rf"{file}", usecols=FILL_COLUMNS)
+    df = parse_times(df)[FILL_COLUMNS]
+    csv_time = time.perf_counter() - start
+    df["Instrument"] = df["Instrument"].astype("category")
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata(
+        {**key, b"csv_seconds": str(csv_time).encode()}
     )
-    vol_output.append({"engine": engine, **vol})
-output_df = pd.DataFrame(
-    output,
-    columns=[
-        "Engine",
-        "Trading Days",
-        "Positions",
-        "Over Night Positions",
-        "Average Position Duration(Minutes)",
-        "Trades",
-        "Volume",
-    ],
-)
-print(output_df)
-vol_output_df = pd.DataFrame(vol_output)
-print(vol_output_df)
-output_df.to_csv(r"stats.csv", index=False)
-vol_output_df.to_csv(r"volumes.csv", index=False)
+    temp_path = f"{cache_path}.tmp"
+    with pa.OSFile(temp_path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    os.replace(temp_path, cache_path)
+    print(f"{engine}: loaded from csv in {csv_time:.3f}s, cache written")
+    return df
+
+
+def process_engine(
+    file: str, engine_mode: str = "vectorized", verify: bool = False, cache_dir: Optional[str] = None
+) -> Tuple[list, dict]:
+    """Compute the stats.csv and volumes.csv rows of one engine fill file."""
+    engine = file.split(".")[0]
+    if cache_dir:
+        df = load_fills_cached(file, cache_dir)
+    else:
+        df = pd.read_csv(rf"{file}")
+    trades = df["ClOrdID"].nunique()
+    df = parse_fills(df)
+    # One fallback open time for both engines, so that --verify compares like with like
+    now = datetime.now()
+    if engine_mode == "loop":
+        positions_df, vol = reconstruct_positions_loop(df, now)
+    else:
+        positions_df, vol = reconstruct_positions(df, now=now)
+    if verify:
+        loop_positions_df, loop_vol = reconstruct_positions_loop(df, now)
+        pd.testing.assert_frame_equal(positions_df, loop_positions_df, check_dtype=False)
+        assert list(vol.items()) == list(loop_vol.items()), f"{engine}: volumes differ"
+    return engine_stats(engine, df, positions_df, vol, trades), {"engine": engine, **vol}
+
+
+def new_checkpoint() -> dict:
+    """Empty per-engine state, as if no fill had been processed yet."""
+    return {
+        "offset": 0,
+        "head": b"",
+        "columns": None,
+        "last_time": None,
+        "open_positions": {},
+        "vol": {},
+        "clordids": set(),
+        "dates": set(),
+        # Closed positions, and the duration_total of their durations for the mean
+        "positions": 0,
+        "duration_ns": 0,
+        "duration_count": 0,
+        "overnight": 0,
+    }
+
+
+def load_checkpoint(path: str, file: str) -> Optional[dict]:
+    """Load an engine checkpoint, or None if it is missing or no longer matches the file."""
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as reader:
+        state = pickle.load(reader)
+    # Checkpoints from before the exact duration total
+    if "duration_ns" not in state:
+        return None
+    # Fills are only ever appended: a shorter file or a different head means it was rewritten
+    if os.path.getsize(file) < state["offset"]:
+        return None
+    with open(file, "rb") as reader:
+        if reader.read(len(state["head"])) != state["head"]:
+            return None
+    return state
+
+
+def save_checkpoint(path: str, state: dict) -> None:
+    """Write the checkpoint atomically so a killed run never leaves a torn state file."""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as writer:
+        pickle.dump(state, writer, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, path)
+
+
+def read_new_fills(file: str, state: dict) -> Tuple[pd.DataFrame, int]:
+    """Read the complete lines appended after the checkpoint offset."""
+    with open(file, "rb") as reader:
+        reader.seek(state["offset"])
+        data = reader.read()
+    # A partially written last line is left for the next run
+    end = data.rfind(b"\n") + 1
+    if not data[:end].strip():
+        return pd.DataFrame(), state["offset"]
+    if state["offset"] == 0:
+        df = pd.read_csv(io.BytesIO(data[:end]), dtype={"ClOrdID": str})
+    else:
+        df = pd.read_csv(
+            io.BytesIO(data[:end]), header=None, names=state["columns"], dtype={"ClOrdID": str}
+        )
+    return df, state["offset"] + end
+
+
+def fold_fills(state: dict, df: pd.DataFrame) -> None:
+    """Fold a batch of parsed, time sorted fills that follow the state's fills into it."""
+    state["clordids"].update(df["ClOrdID"].dropna())
+    positions_df, vol = reconstruct_positions(df, state["open_positions"])
+    for mkt, volume in vol.items():
+        state["vol"][mkt] = state["vol"].get(mkt, 0) + volume
+    state["dates"].update(df["Date"].unique())
+    duration_ns, duration_count = duration_total(positions_df)
+    state["positions"] += len(positions_df)
+    state["duration_ns"] += duration_ns
+    state["duration_count"] += duration_count
+    state["overnight"] += positions_df["OverNight"].sum()
+    state["last_time"] = df["UTCTime"].iloc[-1]
+
+
+def state_stats(engine: str, state: dict) -> Tuple[list, dict]:
+    """Build the stats.csv and volumes.csv rows of an engine from its folded state."""
+    vol = state["vol"]
+    stats_row = [
+        engine,
+        len(state["dates"]),
+        state["positions"],
+        state["overnight"],
+        mean_duration(state["duration_ns"], state["duration_count"]),
+        len(state["clordids"]),
+        sum(vol.values()),
+    ]
+    return stats_row, {"engine": engine, **vol}
+
+
+def verify_against_full(file: str, stats_row: list, vol_row: dict) -> None:
+    """Fail if the rows differ from a full in-memory run over the same file."""
+    full_stats_row, full_vol_row = process_engine(file)
+    pd.testing.assert_frame_equal(
+        pd.DataFrame([stats_row], columns=STATS_COLUMNS),
+        pd.DataFrame([full_stats_row], columns=STATS_COLUMNS),
+        check_dtype=False,
+        check_exact=True,
+    )
+    assert list(full_vol_row.items()) == list(vol_row.items()), f"{file}: volumes differ"
+
+
+def update_checkpoint(file: str, state: dict) -> Optional[dict]:
+    """Fold the fills appended since the checkpoint into the engine state (None if they are out of order)."""
+    df, offset = read_new_fills(file, state)
+    if df.empty:
+        return state
+    if state["columns"] is None:
+        state["columns"] = list(df.columns)
+    df = parse_fills(df)
+    if state["last_time"] is not None and df["UTCTime"].iloc[0] < state["last_time"]:
+        print(f"{file}: appended fills start before {state['last_time']}")
+        return None
+    fold_fills(state, df)
+    state["offset"] = offset
+    with open(file, "rb") as reader:
+        state["head"] = reader.read(min(offset, 4096))
+    return state
+
+
+def process_engine_incremental(
+    file: str, checkpoint_dir: str, full: bool = False, verify: bool = False
+) -> Tuple[list, dict]:
+    """Like process_engine, but only parses the fills appended since the engine checkpoint."""
+    engine = file.split(".")[0]
+    checkpoint_path = os.path.join(checkpoint_dir, f"{engine}.pkl")
+    state = None if full else load_checkpoint(checkpoint_path, file)
+    state = update_checkpoint(file, state or new_checkpoint())
+    if state is None:
+        print(f"Recomputing {engine} in full")
+        state = update_checkpoint(file, new_checkpoint())
+    save_checkpoint(checkpoint_path, state)
+
+    stats_row, vol_row = state_stats(engine, state)
+    if verify:
+        verify_against_full(file, stats_row, vol_row)
+    return stats_row, vol_row
+
+
+def chunk_sizes(file: str, memory_mb: float) -> Tuple[int, int]:
+    """
+    Rows per csv chunk and per merge block that keep a streaming run under memory_mb.
+
+    Parsed rows take roughly IN_MEMORY_ROW_FACTOR times their csv size. The merge of an
+    external sort holds one block of every sorted run, so blocks shrink as runs grow.
+    """
+    with open(file, "rb") as reader:
+        sample = reader.read(1 << 16)
+    line_bytes = max(len(sample) / max(sample.count(b"\n"), 1), 1.0)
+    chunk_rows = max(int(memory_mb * 2**20 / (line_bytes * IN_MEMORY_ROW_FACTOR)), 1000)
+    runs = math.ceil(os.path.getsize(file) / (chunk_rows * line_bytes))
+    return chunk_rows, max(chunk_rows // (runs + 1), 100)
+
+
+def read_chunks(file: str, chunk_rows: int) -> Iterator[pd.DataFrame]:
+    """Read the fills in chunks, with UTCTime parsed."""
+    # ClOrdID as text so that every chunk infers the same ids
+    for chunk in pd.read_csv(rf"{file}", chunksize=chunk_rows, dtype={"ClOrdID": str}):
+        yield parse_times(chunk)
+
+
+def merge_sorted_runs(paths: List[str]) -> Iterator[pd.DataFrame]:
+    """
+    Merge sorted runs (files of pickled DataFrame blocks) into time sorted batches.
+
+    Only rows earlier than the smallest last time buffered from a run that still has
+    blocks on disk are emitted, so later blocks can never sort before them. Ties keep run
+    order, which is file order, matching a stable sort of the whole file.
+    """
+    readers = [open(path, "rb") for path in paths]
+    buffers: List[Optional[pd.DataFrame]] = [None] * len(readers)
+
+    def next_block(run: int) -> Optional[pd.DataFrame]:
+        try:
+            return pickle.load(readers[run])
+        except EOFError:
+            readers[run].close()
+            return None
+
+    try:
+        pending = set(range(len(readers)))
+        for run in range(len(readers)):
+            buffers[run] = next_block(run)
+            if buffers[run] is None:
+                pending.discard(run)
+        while any(buffer is not None and len(buffer) for buffer in buffers):
+            if pending:
+                cutoff = min(buffers[run]["UTCTime"].iloc[-1] for run in pending)
+            parts = []
+            for run, buffer in enumerate(buffers):
+                if buffer is None or not len(buffer):
+                    continue
+                if pending:
+                    split = int(buffer["UTCTime"].searchsorted(cutoff, side="left"))
+                else:
+                    split = len(buffer)
+                if split:
+                    parts.append(buffer.iloc[:split])
+                    buffers[run] = buffer.iloc[split:]
+            if parts:
+                yield pd.concat(parts).sort_values(by="UTCTime", kind="stable")
+            # Refill emptied buffers, and grow the buffers holding only cutoff time ties
+            for run in list(pending):
+                buffer = buffers[run]
+                if not len(buffer) or (not parts and buffer["UTCTime"].iloc[-1] == cutoff):
+                    block = next_block(run)
+                    if block is None:
+                        pending.discard(run)
+                    else:
+                        buffers[run] = pd.concat([buffer, block])
+    finally:
+        for reader in readers:
+            reader.close()
+
+
+def external_sort_chunks(file: str, chunk_rows: int, block_rows: int) -> Iterator[pd.DataFrame]:
+    """Time sort a fill file larger than memory: sort it chunk by chunk to disk, then merge."""
+    with tempfile.TemporaryDirectory(prefix="griffin-stats-") as temp_dir:
+        paths = []
+        for i, chunk in enumerate(read_chunks(file, chunk_rows)):
+            chunk = chunk.sort_values(by="UTCTime", kind="stable")
+            paths.append(os.path.join(temp_dir, f"run{i}.pkl"))
+            with open(paths[-1], "wb") as writer:
+                for start in range(0, len(chunk), block_rows):
+                    pickle.dump(chunk.iloc[start:start + block_rows], writer, pickle.HIGHEST_PROTOCOL)
+        yield from merge_sorted_runs(paths)
+
+
+class DistinctCounter:
+    """
+    Count distinct strings while holding at most max_items of them in memory.
+
+    Past that, the held strings are spilled to partition files by hash. Equal strings
+    always land in the same partition, so the distinct count is the sum of the distinct
+    counts of the partitions, each read back on its own.
+    """
+
+    def __init__(self, max_items: int, partitions: int = CLORDID_PARTITIONS):
+        self.max_items = max_items
+        self.partitions = partitions
+        self.items: set = set()
+        self.temp_dir: Optional[tempfile.TemporaryDirectory] = None
+
+    def update(self, values) -> None:
+        self.items.update(values)
+        if len(self.items) > self.max_items:
+            self.spill()
+
+    def spill(self) -> None:
+        if self.temp_dir is None:
+            self.temp_dir = tempfile.TemporaryDirectory(prefix="griffin-stats-ids-")
+        parts: List[List[str]] = [[] for _ in range(self.partitions)]
+        for item in self.items:
+            parts[hash(item) % self.partitions].append(item)
+        for i, part in enumerate(parts):
+            if part:
+                with open(os.path.join(self.temp_dir.name, f"ids{i}.txt"), "a") as writer:
+                    writer.write("\n".join(part) + "\n")
+        self.items = set()
+
+    def __len__(self) -> int:
+        if self.temp_dir is None:
+            return len(self.items)
+        self.spill()
+        count = 0
+        for i in range(self.partitions):
+            path = os.path.join(self.temp_dir.name, f"ids{i}.txt")
+            if os.path.exists(path):
+                with open(path) as reader:
+                    count += len(set(reader.read().splitlines()))
+        return count
+
+    def close(self) -> None:
+        if self.temp_dir is not None:
+            self.temp_dir.cleanup()
+            self.temp_dir = None
+
+
+def new_streaming_state(memory_mb: float) -> dict:
+    """Empty engine state whose ClOrdIDs spill to disk past their share of memory_mb."""
+    state = new_checkpoint()
+    state["clordids"] = DistinctCounter(
+        max(int(memory_mb * 2**20 * CLORDID_MEMORY_SHARE / CLORDID_BYTES), 1000)
+    )
+    return state
+
+
+def process_engine_streaming(file: str, memory_mb: float, verify: bool = False) -> Tuple[list, dict]:
+    """
+    Like process_engine, but streams the file in chunks sized to stay under memory_mb. The
+    stats are folded with exact integer duration totals, so the chunking and the external
+    sort give the same stats.csv as the in-memory run.
+    """
+    engine = file.split(".")[0]
+    chunk_rows, block_rows = chunk_sizes(file, memory_mb)
+    state = new_streaming_state(memory_mb)
+    try:
+        for chunk in read_chunks(file, chunk_rows):
+            times = chunk["UTCTime"].to_numpy()
+            if (times[1:] < times[:-1]).any() or (
+                state["last_time"] is not None and times[0] < state["last_time"]
+            ):
+                print(f"{engine}: fills are not time sorted, using an external merge sort")
+                state["clordids"].close()
+                state = new_streaming_state(memory_mb)
+                for batch in external_sort_chunks(file, chunk_rows, block_rows):
+                    fold_fills(state, batch)
+                break
+            fold_fills(state, chunk)
+        stats_row, vol_row = state_stats(engine, state)
+    finally:
+        state["clordids"].close()
+    if verify:
+        verify_against_full(file, stats_row, vol_row)
+    return stats_row, vol_row
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Engine position and volume stats.")
+    parser.add_argument("folder", help="Folder containing the engine fill csv files")
+    parser.add_argument(
+        "-e",
+        "--engine",
+        choices=["vectorized", "loop"],
+        default="vectorized",
+        help="Position reconstruction engine (loop is the original row by row reference)",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Fail if the result differs from the loop engine (or, with --checkpoint_dir or --stream_mb, "
+        "from a full in-memory recompute, exactly)",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of engine files to process concurrently in a process pool",
+    )
+    parser.add_argument(
+        "-k",
+        "--checkpoint_dir",
+        help="Keep per-engine checkpoints here and only process fills appended since the last run",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="With --checkpoint_dir, ignore the saved checkpoints and recompute every engine",
+    )
+    parser.add_argument(
+        "-c",
+        "--cache_dir",
+        help="Load the engine files through typed Arrow sidecar files kept here (needs pyarrow)",
+    )
+    parser.add_argument(
+        "-s",
+        "--stream_mb",
+        type=float,
+        help="Stream every engine file in chunks, keeping each worker's fills under this many MB",
+    )
+    parser.add_argument(
+        "--bench_parse",
+        action="store_true",
+        help="Only benchmark the UTCTime parsers on every engine file and exit",
+    )
+    args = parser.parse_args()
+    if (args.checkpoint_dir or args.stream_mb) and args.engine != "vectorized":
+        parser.error("--checkpoint_dir and --stream_mb require the vectorized engine")
+    if args.stream_mb and (args.checkpoint_dir or args.cache_dir):
+        parser.error("--stream_mb cannot be combined with --checkpoint_dir or --cache_dir")
+    if args.checkpoint_dir:
+        if args.cache_dir:
+            parser.error("--checkpoint_dir only reads the new tail and cannot use --cache_dir")
+        args.checkpoint_dir = os.path.abspath(args.checkpoint_dir)
+        os.makedirs(args.checkpoint_dir, exist_ok=True)
+    if args.cache_dir:
+        args.cache_dir = os.path.abspath(args.cache_dir)
+        os.makedirs(args.cache_dir, exist_ok=True)
+
+    os.chdir(args.folder)
+    files = [
+        file
+        for file in glob.glob("*.{}".format("csv"))
+        if file.split(".")[0] not in ("stats", "volumes")
+    ]
+    if args.bench_parse:
+        benchmark_time_parsing(files)
+        sys.exit(0)
+    if args.checkpoint_dir:
+        task = partial(
+            process_engine_incremental,
+            checkpoint_dir=args.checkpoint_dir,
+            full=args.full,
+            verify=args.verify,
+        )
+    elif args.stream_mb:
+        task = partial(process_engine_streaming, memory_mb=args.stream_mb, verify=args.verify)
+    else:
+        task = partial(
+            process_engine, engine_mode=args.engine, verify=args.verify, cache_dir=args.cache_dir
+        )
+    if args.workers > 1:
+        # Engines are independent: start the biggest files first so one large engine
+        # does not run alone at the end, then merge the results back in file order
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            futures = {
+                file: executor.submit(task, file)
+                for file in sorted(files, key=os.path.getsize, reverse=True)
+            }
+            results = [futures[file].result() for file in files]
+    else:
+        results = [task(file) for file in files]
+    output = [stats_row for stats_row, _ in results]
+    vol_output = [vol_row for _, vol_row in results]
+    output_df = pd.DataFrame(output, columns=STATS_COLUMNS)
+    print(output_df)
+    vol_output_df = pd.DataFrame(vol_output)
+    print(vol_output_df)
+    output_df.to_csv(r"stats.csv", index=False)
+    vol_output_df.to_csv(r"volumes.csv", index=False)